@@ -130,6 +130,18 @@ class FeedAdmin(BaseModelAdmin):
         clear_feed_data
     ]
 
+@admin.register(models.PendingDownload)
+class PendingDownloadAdmin(BaseModelAdmin):
+    list_display = ['__str__', 'feed', 'qbittorrent', 'torrent_hash', 'status', 'api_call_count', 'added_at']
+    list_filter = ['status', 'qbittorrent']
+    search_fields = ['torrent_hash', 'feed__anime__title']
+    readonly_fields = ['entry', 'api_calls']
+    all_readonly_fields = not settings.DEBUG
+    ordering = ['-added_at']
+
+    def api_call_count(self, obj):
+        return obj.get_api_call_count()
+
 @admin.register(models.Tracker)
 class TrackerAdmin(BaseModelAdmin):
     pass
@@ -189,14 +201,18 @@ class EpisodeTitle(BaseModelAdmin):
 
 @admin.register(models.EpisodeInfo)
 class EpisodeInfoAdmin(BaseModelAdmin):
+    list_display = ['episode', 'release_group', 'preset', 'crf', 'encode_speed']
+    list_filter = ['preset']
+    readonly_fields = ['timings', 'preset', 'crf', 'encode_speed']
     all_readonly_fields = not settings.DEBUG
 
 @admin.register(models.Episode)
 class EpisodeAdmin(BaseModelAdmin):
-    list_display = ['name', 'resolution', 'release_group', 'episode_size', 'get_episode_status_display']
+    list_display = ['name', 'resolution', 'release_group', 'episode_size', 'get_episode_status_display', 'encode_progress']
     list_filter = ['resolution', 'episode_status', 'info__release_group']
     list_select_related = ('info',)
     search_fields = ['anime__title', 'info__release_group', 'name']
+    readonly_fields = ['encode_progress']
     all_readonly_fields = not settings.DEBUG
 
     actions = [
@@ -209,6 +225,9 @@ class EpisodeAdmin(BaseModelAdmin):
     def episode_size(self, obj):
         return obj.info.get_new_file_size() if obj.info.new_file_size > 0 else '-'
 
+    def encode_progress(self, obj):
+        return obj.get_encode_progress()
+
 @admin.register(models.Batch)
 class BatchAdmin(BaseModelAdmin):
     save_on_top = True
@@ -301,16 +320,25 @@ class AdflyCredentialAdmin(BaseModelAdmin):
 
 @admin.register(models.QBitTorrent)
 class QBitTorrentAdmin(BaseModelAdmin):
+    list_display = ['__str__', 'download_path', 'max_downloads', 'min_free_space', 'active_downloads', 'enabled']
+    list_filter = ['enabled']
 
-    def add_view(self, request, form_url='', extra_context=None):
-        qb = models.QBitTorrent.objects.all().first()
-        if qb:
-            return self.change_view(request, object_id=str(qb.id))
-        else:
-            return super(QBitTorrentAdmin, self).add_view(request, form_url, extra_context)
+    actions = [
+        set_enabled, set_disabled
+    ]
 
-    def changelist_view(self, request, extra_context=None):
-        return self.add_view(request)
+    def active_downloads(self, obj):
+        return obj.pending_downloads.filter(status='dl').count()
+
+@admin.register(models.DiskReservation)
+class DiskReservationAdmin(BaseModelAdmin):
+    list_display = ['label', 'kind', 'path', 'reserved_size', 'added_at']
+    list_filter = ['kind']
+    all_readonly_fields = True
+    ordering = ['-added_at']
+
+    def reserved_size(self, obj):
+        return obj.get_size()
 
 @admin.register(models.PostTopic)
 class PostTopicAdmin(BaseModelAdmin):
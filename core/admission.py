@@ -0,0 +1,180 @@
+import os
+import shutil
+from datetime import timedelta
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models import Sum, Count
+from django.utils import timezone
+
+from core import models, utils
+
+# Output to source size ratios until there is encode history to go by.
+DEFAULT_SIZE_RATIOS = {1080: 0.6, 720: 0.35, 480: 0.2}
+
+
+class NoDiskSpace(Exception):
+    pass
+
+
+def get_device(path):
+    return os.stat(path).st_dev
+
+def get_free_space(path):
+    return shutil.disk_usage(path).free - getattr(settings, 'DISK_FREE_RESERVE', 5 * 1024 ** 3)
+
+def get_reservations():
+    # Reservations of workers that died are dropped after a while.
+    timeout = getattr(settings, 'DISK_RESERVATION_TIMEOUT', 60 * 60 * 24)
+    return models.DiskReservation.objects.filter(added_at__gte=timezone.now() - timedelta(seconds=timeout))
+
+def reserve(kind, footprint, label=''):
+    """
+    Reserves footprint, a dict of path to bytes, or raises NoDiskSpace when
+    any of the paths lacks the room.
+    """
+    reservations = []
+    try:
+        for path, size in footprint.items():
+            reservations.append(models.DiskReservation.objects.create(
+                kind=kind, label=label, path=path, device=get_device(path), size=int(size)
+            ))
+
+        # Checked once the reservations exist, so two jobs racing for the
+        # same space both back off instead of both going ahead.
+        for reservation in reservations:
+            reserved = get_reserved_size(reservation.device)
+            free_space = get_free_space(reservation.path)
+            if reserved > free_space:
+                raise NoDiskSpace('{} needs {} more in {}'.format(
+                    label, utils.humansize(reserved - free_space), reservation.path
+                ))
+    except Exception:
+        release(reservations)
+        raise
+
+    return reservations
+
+def iter_files(path):
+    if not os.path.isdir(path):
+        yield path
+        return
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            yield os.path.join(root, file_name)
+
+def get_written_size(reservation):
+    written = 0
+    for path in reservation.file_paths:
+        for file_path in iter_files(path):
+            try:
+                file_stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            if file_stat.st_dev == reservation.device:
+                written += file_stat.st_size
+    return written
+
+def get_reserved_size(device):
+    # Free space already lacks what the jobs have written, only the rest of
+    # their footprint is still to come.
+    return sum(
+        max(0, reservation.size - get_written_size(reservation))
+        for reservation in get_reservations().filter(device=device)
+    )
+
+def track(reservations, file_paths):
+    """
+    Records the files or directories the jobs holding reservations write
+    to, so their output is not counted against the disk twice.
+    """
+    for reservation in reservations or []:
+        reservation.file_paths = utils.remove_duplicates(reservation.file_paths + list(file_paths))
+        models.DiskReservation.objects.filter(pk=reservation.pk).update(file_paths=reservation.file_paths)
+
+def release(reservations):
+    models.DiskReservation.objects.filter(pk__in=[r.pk for r in reservations]).delete()
+
+@contextmanager
+def admit(kind, footprint, label=''):
+    reservations = reserve(kind, footprint, label)
+    try:
+        yield reservations
+    finally:
+        release(reservations)
+
+def merge_footprint(footprint):
+    # Paths on the same filesystem share one budget, and moves within it
+    # are renames that need no extra room.
+    merged = {}
+    for path, size in footprint.items():
+        device = get_device(path)
+        merged_path, merged_size = merged.get(device, (path, 0))
+        merged[device] = (merged_path, max(merged_size, size))
+    return dict(merged.values())
+
+def get_size_ratio(resolution):
+    samples = models.EpisodeInfo.objects.filter(
+        episode__resolution=resolution, original_file_size__gt=0, new_file_size__gt=0
+    ).order_by('-added_at').values_list('original_file_size', 'new_file_size')[:getattr(settings, 'DISK_SIZE_SAMPLES', 20)]
+
+    ratios = [new_file_size / original_file_size for original_file_size, new_file_size in samples]
+    if not ratios:
+        return DEFAULT_SIZE_RATIOS.get(resolution, 1)
+    # The largest recent ratio, a busy week should not run out on the
+    # one episode that compresses badly.
+    return max(ratios)
+
+def get_encode_footprint(source_size, resolutions):
+    output_size = sum(source_size * get_size_ratio(resolution) for resolution in resolutions)
+    output_size *= getattr(settings, 'DISK_SIZE_MARGIN', 1.2)
+
+    # Encodes are written to BASE_DIR/episodes and then moved into storage.
+    return merge_footprint({
+        utils.create_and_get_path(os.path.join(settings.BASE_DIR, 'episodes')): output_size,
+        utils.create_and_get_path(settings.MEDIA_ROOT): output_size,
+    })
+
+def get_batch_footprint(batch_obj):
+    total_size = batch_obj.total_size or sum(
+        episode.info.new_file_size for episode in batch_obj.episodes.all()
+    )
+    # Episodes are usually hard linked into the workspace, but copied when
+    # they sit on another filesystem.
+    return {utils.create_and_get_path(os.path.join(settings.BASE_DIR, 'batches')): total_size}
+
+def get_metrics():
+    lines = []
+
+    paths = {
+        'downloads': os.path.join(settings.BASE_DIR, 'downloads'),
+        'episodes': os.path.join(settings.BASE_DIR, 'episodes'),
+        'batches': os.path.join(settings.BASE_DIR, 'batches'),
+        'media': settings.MEDIA_ROOT,
+    }
+    lines.append('# HELP automin_disk_free_bytes Free space of the volumes jobs write to.')
+    lines.append('# TYPE automin_disk_free_bytes gauge')
+    for name, path in paths.items():
+        if os.path.exists(path):
+            lines.append('automin_disk_free_bytes{{volume="{}"}} {}'.format(name, shutil.disk_usage(path).free))
+
+    reservations = get_reservations().values('kind', 'path').annotate(size=Sum('size'), count=Count('id'))
+    lines.append('# HELP automin_disk_reserved_bytes Space reserved by the admitted jobs.')
+    lines.append('# TYPE automin_disk_reserved_bytes gauge')
+    for reservation in reservations:
+        lines.append('automin_disk_reserved_bytes{{kind="{}",path="{}"}} {}'.format(
+            reservation['kind'], reservation['path'], reservation['size']
+        ))
+    lines.append('# HELP automin_disk_reservations Jobs holding a disk reservation.')
+    lines.append('# TYPE automin_disk_reservations gauge')
+    for reservation in reservations:
+        lines.append('automin_disk_reservations{{kind="{}",path="{}"}} {}'.format(
+            reservation['kind'], reservation['path'], reservation['count']
+        ))
+
+    lines.append('# HELP automin_pending_downloads Feed downloads by status.')
+    lines.append('# TYPE automin_pending_downloads gauge')
+    for status in models.PendingDownload.objects.order_by().values('status').annotate(count=Count('id')):
+        lines.append('automin_pending_downloads{{status="{}"}} {}'.format(status['status'], status['count']))
+
+    return '\n'.join(lines) + '\n'
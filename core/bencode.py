@@ -0,0 +1,67 @@
+# torrentool turns every valid utf8 string into str and cannot encode bytes
+# dictionary keys, which v2 torrents use for their piece layers. Strings are
+# kept as bytes here, keys are str when they are valid utf8.
+
+
+def encode(value):
+    if isinstance(value, str):
+        value = value.encode('utf8')
+
+    if isinstance(value, (bytes, bytearray)):
+        return str(len(value)).encode() + b':' + bytes(value)
+
+    if isinstance(value, bool) or not isinstance(value, (int, list, tuple, dict)):
+        raise ValueError(f'Unable to bencode {type(value)}')
+
+    if isinstance(value, int):
+        return b'i%de' % value
+
+    if isinstance(value, (list, tuple)):
+        return b'l' + b''.join(encode(item) for item in value) + b'e'
+
+    # Keys are sorted as raw bytes, as the spec asks.
+    items = sorted(
+        (key.encode('utf8') if isinstance(key, str) else bytes(key), item) for key, item in value.items()
+    )
+    return b'd' + b''.join(encode(key) + encode(item) for key, item in items) + b'e'
+
+
+def decode(data):
+    value, end = decode_value(bytes(data), 0)
+    if end != len(data):
+        raise ValueError('Trailing data after bencoded value')
+    return value
+
+
+def decode_value(data, index):
+    char = data[index:index + 1]
+
+    if char == b'i':
+        end = data.index(b'e', index)
+        return int(data[index + 1:end]), end + 1
+
+    if char == b'l':
+        index, items = index + 1, []
+        while data[index:index + 1] != b'e':
+            item, index = decode_value(data, index)
+            items.append(item)
+        return items, index + 1
+
+    if char == b'd':
+        index, items = index + 1, {}
+        while data[index:index + 1] != b'e':
+            key, index = decode_value(data, index)
+            try:
+                key = key.decode('utf8')
+            except UnicodeDecodeError:
+                pass
+            items[key], index = decode_value(data, index)
+        return items, index + 1
+
+    if char.isdigit():
+        colon = data.index(b':', index)
+        start = colon + 1
+        end = start + int(data[index:colon])
+        return data[start:end], end
+
+    raise ValueError(f'Unable to bdecode {char!r} at {index}')
@@ -1,19 +1,26 @@
+import io
 import os
+import json
+import time
 import uuid
 import random
+import shutil
+import hashlib
+import threading
+import subprocess
+import traceback
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
 
 from django.conf import settings
 
 import ffmpeg
-from pymediainfo import MediaInfo
-
-from core import utils
+from core import probes, utils
 
 
 class BaseEncoder:
 
-    def get_ffmpeg_args(self, audio_bitrate, audio_quality, crf, deblock, psy_rd, psy_rdoq, aq_strength, vf_args, params_args=[], extra_args={}):
+    def get_ffmpeg_args(self, audio_bitrate, audio_quality, crf, deblock, psy_rd, psy_rdoq, aq_strength, vf_args, params_args=[], extra_args={}, preset='slow'):
         return {
             'c:a': 'aac',
             'c:v': 'libx265',
@@ -39,7 +46,7 @@ class BaseEncoder:
                 *params_args,
             ]),
             'crf': crf,
-            'preset': 'slow',
+            'preset': preset,
             'pix_fmt': 'yuv420p',
             'vf': ','.join(vf_args),
             'metadata': 'Yugen',
@@ -53,17 +60,30 @@ class BaseEncoder:
     def get_settings(self, subtitles_path, extra_args):
         crf = int(self.config['crf'])
         deblock = self.config['deblock']
-        smartblur = self.config['smartblur']
-        deinterlace = self.config['deinterlace']
         resolution = self.config['resolution']
         psy_rd = self.config['psy_rd']
         psy_rdoq = self.config['psy_rdoq']
         aq_strength = self.config['aq_strength']
-        hardsubs = self.config['hardsubs']
 
         audio_bitrate, audio_quality, crf, vf_args = self.resolution_settings(
             resolution, crf)
-        params_args = []
+        filter_args, params_args = self.get_filters(subtitles_path, extra_args)
+        vf_args.extend(filter_args)
+
+        if not all([audio_bitrate, audio_quality, crf, deblock, psy_rd, psy_rdoq, aq_strength, vf_args]):
+            raise Exception('Config value error')
+
+        return self.get_ffmpeg_args(
+            audio_bitrate, audio_quality, crf, deblock, psy_rd, psy_rdoq, aq_strength, vf_args, params_args, extra_args,
+            preset=self.config.get('preset', 'slow')
+        )
+
+    def get_filters(self, subtitles_path, extra_args):
+        smartblur = self.config['smartblur']
+        deinterlace = self.config['deinterlace']
+        hardsubs = self.config['hardsubs']
+
+        vf_args, params_args = [], []
 
         if extra_args.get('f') == 'mp4' and not hardsubs:
             vf_args.append(f'subtitles=\'{subtitles_path}\'')
@@ -76,10 +96,101 @@ class BaseEncoder:
             params_args.append('fps=23976/1000')
             extra_args.update({'framerate': '23976/1000'})
 
-        if not all([audio_bitrate, audio_quality, crf, deblock, psy_rd, psy_rdoq, aq_strength, vf_args]):
-            raise Exception('Config value error')
+        return vf_args, params_args
+
+    def get_audio_file_path(self, ffmpeg_arguments):
+        audio_file_path = self.config.get('audio_file_paths', {}).get(ffmpeg_arguments['b:a'])
+        if audio_file_path:
+            ffmpeg_arguments['c:a'] = 'copy'
+            ffmpeg_arguments.pop('b:a')
+        return audio_file_path
+
+    def is_source_audio(self, audio_file_path):
+        return not audio_file_path or \
+            os.path.abspath(audio_file_path) == os.path.abspath(str(self.source_file_path))
+
+    def fetch_cached(self, ffmpeg_arguments):
+        self.cache_key = EncodeCache.get_key(
+            self.config.get('source_hash'), self.config['resolution'],
+            {**ffmpeg_arguments, 'encoder': type(self).__name__}
+        )
+        return EncodeCache().fetch(self.cache_key, self.output_file_path)
+
+    def store_cached(self):
+        EncodeCache().store(self.cache_key, self.output_file_path)
+
+    def run(self, ffmpeg_command, progress_callback=None):
+        progress_callback = progress_callback or self.config.get('progress_callback')
+        input_reader = self.config.get('input_reader')
+        if not (progress_callback or input_reader):
+            subprocess.run(ffmpeg_command, check=True)
+            return
+
+        if input_reader:
+            ffmpeg_command = self.pipe_source(ffmpeg_command)
+
+        process = subprocess.Popen(
+            [ffmpeg_command[0], '-progress', 'pipe:1', '-nostats', *ffmpeg_command[1:]],
+            stdin=subprocess.PIPE if input_reader else None, stdout=subprocess.PIPE
+        )
 
-        return self.get_ffmpeg_args(audio_bitrate, audio_quality, crf, deblock, psy_rd, psy_rdoq, aq_strength, vf_args, params_args, extra_args)
+        input_errors = []
+        if input_reader:
+            feeder = threading.Thread(
+                target=self.feed_input, args=(input_reader, process.stdin, input_errors), daemon=True
+            )
+            feeder.start()
+
+        # ffmpeg writes key=value lines and closes every block with a
+        # progress=continue or progress=end line.
+        progress = {}
+        for line in io.TextIOWrapper(process.stdout):
+            key, _, value = line.strip().partition('=')
+            progress[key] = value
+            if key == 'progress':
+                if progress_callback:
+                    progress_callback(progress)
+                progress = {}
+
+        returncode = process.wait()
+
+        if input_reader:
+            feeder.join()
+            # A reader that failed closes the pipe early, which ffmpeg takes
+            # for the end of a shorter source.
+            if input_errors:
+                raise input_errors[0]
+
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, ffmpeg_command)
+
+    def pipe_source(self, ffmpeg_command):
+        source_file_path = os.path.abspath(str(self.source_file_path))
+        return [
+            'pipe:0' if i and ffmpeg_command[i - 1] == '-i' and os.path.abspath(arg) == source_file_path else arg
+            for i, arg in enumerate(ffmpeg_command)
+        ]
+
+    @staticmethod
+    def feed_input(input_reader, pipe, input_errors):
+        try:
+            shutil.copyfileobj(input_reader, pipe, 1024 * 1024)
+        except BrokenPipeError:
+            # ffmpeg exited first, its return code says why.
+            pass
+        except Exception as e:
+            input_errors.append(e)
+        finally:
+            try:
+                pipe.close()
+            except BrokenPipeError:
+                pass
+
+    def get_output_args(self, ffmpeg_arguments):
+        output_args = []
+        for key, value in ffmpeg_arguments.items():
+            output_args.extend([f'-{key}', str(value)])
+        return output_args
 
     def resolution_settings(self, resolution, crf):
         return {
@@ -107,14 +218,24 @@ class BaseEncoder:
 
     @property
     def valid(self):
-        return self.size > 0
+        if not self.size > 0:
+            return False
+
+        return probes.MediaProbe(self.output_file_path).matches(
+            probes.MediaProbe(self.source_file_path), self.config.get('deinterlace')
+        )
 
 
 class EncodeVideoMP4(BaseEncoder):
 
+    output_args = {
+        'f': 'mp4',
+    }
+
     def __init__(self, file_path, output_file_path, config):
         super(EncodeVideoMP4, self).__init__()
         self.config = config
+        self.source_file_path = file_path
         self.output_file_path = output_file_path
         file_name = os.path.basename(file_path)
         file_path = os.path.abspath(str(file_path)).replace('\\', '\\\\')
@@ -122,30 +243,46 @@ class EncodeVideoMP4(BaseEncoder):
         output_file_path = os.path.abspath(
             str(output_file_path)).replace('\\', '\\\\')
 
-        ffmpeg_arguments = self.get_settings(subtitles_path, {
-            'f': 'mp4',
-        })
+        ffmpeg_arguments = self.get_settings(subtitles_path, dict(self.output_args))
+        audio_file_path = self.get_audio_file_path(ffmpeg_arguments)
+        self.cached = self.fetch_cached(ffmpeg_arguments)
 
-        utils.check_and_delete(output_file_path)
+        if not self.cached:
+            utils.check_and_delete(output_file_path)
 
-        stream = ffmpeg.input(file_path)
-        stream = ffmpeg.output(
-            stream.video, stream.audio, output_file_path, **ffmpeg_arguments
-        )
-        stream = ffmpeg.overwrite_output(stream)
-        ffmpeg.run(stream)
+            stream = ffmpeg.input(file_path)
+            audio_stream = stream.audio
+            if not self.is_source_audio(audio_file_path):
+                audio_stream = ffmpeg.input(audio_file_path).audio
+            stream = ffmpeg.output(
+                stream.video, audio_stream, output_file_path, **ffmpeg_arguments
+            )
+            stream = ffmpeg.overwrite_output(stream)
+            self.run(ffmpeg.compile(stream))
 
         if not self.valid:
             raise Exception(f'Episode file named {file_name} not encoded')
 
+        if not self.cached:
+            self.store_cached()
+
         self.file_size = os.path.getsize(self.output_file_path)
 
 
 class EncodeVideoMKV(BaseEncoder):
 
+    output_args = {
+        # 'c:t': 'copy',
+        'map': '0:s?',
+        # 'map': '0:t',
+        # 'metadata:s:t': 'mimetype=application/x-truetype-font',
+        'f': 'matroska',
+    }
+
     def __init__(self, file_path, output_file_path, config):
         super(EncodeVideoMKV, self).__init__()
         self.config = config
+        self.source_file_path = file_path
         self.output_file_path = output_file_path
         file_name = os.path.basename(file_path)
         file_path = os.path.abspath(str(file_path)).replace('\\', '\\\\')
@@ -153,43 +290,531 @@ class EncodeVideoMKV(BaseEncoder):
         output_file_path = os.path.abspath(
             str(output_file_path)).replace('\\', '\\\\')
 
-        ffmpeg_arguments = self.get_settings(subtitles_path, {
-            # 'c:t': 'copy',
-            'map': '0:s?',
-            # 'map': '0:t',
-            # 'metadata:s:t': 'mimetype=application/x-truetype-font',
-            'f': 'matroska',
-        })
+        ffmpeg_arguments = self.get_settings(subtitles_path, dict(self.output_args))
+        audio_file_path = self.get_audio_file_path(ffmpeg_arguments)
+        self.cached = self.fetch_cached(ffmpeg_arguments)
+
+        if not self.cached:
+            utils.check_and_delete(output_file_path)
+
+            stream = ffmpeg.input(file_path)
+            audio_stream = stream.audio
+            if not self.is_source_audio(audio_file_path):
+                audio_stream = ffmpeg.input(audio_file_path).audio
+            stream = ffmpeg.output(
+                stream.video, audio_stream, output_file_path, **ffmpeg_arguments
+            )
+            stream = ffmpeg.overwrite_output(stream)
+            self.run(ffmpeg.compile(stream))
+
+        if not self.valid:
+            raise Exception(f'Episode file named {file_name} not encoded')
+
+        if not self.cached:
+            self.store_cached()
+
+        self.file_size = os.path.getsize(self.output_file_path)
+
+
+class EncodeVideoLadder(BaseEncoder):
+
+    def __init__(self, file_path, output_file_paths, config):
+        super(EncodeVideoLadder, self).__init__()
+        self.config = config
+        self.source_file_path = file_path
+        self.output_file_paths = output_file_paths
+        file_name = os.path.basename(file_path)
+        input_file_path = os.path.abspath(str(file_path))
+        file_path = input_file_path.replace('\\', '\\\\')
+        subtitles_path = utils.purify_path(file_path)
+        output_args = EncodeVideoMP4.output_args if config['hardsubs'] else EncodeVideoMKV.output_args
+        resolutions = sorted(output_file_paths, reverse=True)
+
+        output_commands, audio_inputs, encode_resolutions = [], [], []
+        self.cache_keys = {}
+
+        for resolution in resolutions:
+            self.config = {**config, 'resolution': resolution}
+            self.output_file_path = output_file_paths[resolution]
+            ffmpeg_arguments = self.get_settings(subtitles_path, dict(output_args))
+            audio_file_path = self.get_audio_file_path(ffmpeg_arguments)
+
+            if self.fetch_cached(ffmpeg_arguments):
+                continue
+
+            self.cache_keys[resolution] = self.cache_key
+            encode_resolutions.append(resolution)
+            ffmpeg_arguments.pop('vf')
+
+            audio_map = '0:a'
+            if not self.is_source_audio(audio_file_path):
+                if audio_file_path not in audio_inputs:
+                    audio_inputs.append(audio_file_path)
+                audio_map = f'{audio_inputs.index(audio_file_path) + 1}:a'
+
+            output_file_path = os.path.abspath(str(output_file_paths[resolution]))
+            utils.check_and_delete(output_file_path)
+
+            output_commands.extend([
+                '-map', f'[v{resolution}]', '-map', audio_map,
+                *self.get_output_args(ffmpeg_arguments),
+                output_file_path,
+            ])
+
+        self.config = config
+
+        if encode_resolutions:
+            # Deinterlace, blur and subtitles are resolution independent, so
+            # they run once on the decoded source before the split into renditions.
+            filter_args, _ = self.get_filters(subtitles_path, dict(output_args))
+            filter_args.append(f'split={len(encode_resolutions)}')
+            filter_graph = ['[0:v]{}{}'.format(
+                ','.join(filter_args), ''.join(f'[s{res}]' for res in encode_resolutions)
+            )]
+
+            for resolution in encode_resolutions:
+                scale_args = self.resolution_settings(resolution, config['crf'])[3]
+                filter_graph.append(f'[s{resolution}]{",".join(scale_args)}[v{resolution}]')
+
+            self.run([
+                'ffmpeg', '-y', '-i', input_file_path,
+                *[arg for audio_file_path in audio_inputs for arg in ('-i', audio_file_path)],
+                '-filter_complex', ';'.join(filter_graph),
+                *output_commands
+            ])
+
+        self.file_sizes = {}
+        for resolution in resolutions:
+            self.output_file_path = output_file_paths[resolution]
+            if not self.valid:
+                raise Exception(f'Episode file named {file_name} not encoded in {resolution}p')
+            self.file_sizes[resolution] = self.size
+
+        for resolution, cache_key in self.cache_keys.items():
+            EncodeCache().store(cache_key, output_file_paths[resolution])
+
+
+class EncodeVideoChunked(BaseEncoder):
+
+    audio_args = ('c:a', 'b:a', 'metadata')
+    container_args = ('map', 'f')
+
+    def __init__(self, file_path, output_file_path, config):
+        super(EncodeVideoChunked, self).__init__()
+        self.config = config
+        self.source_file_path = file_path
+        self.output_file_path = output_file_path
+        file_name = os.path.basename(file_path)
+        input_file_path = os.path.abspath(str(file_path))
+        file_path = input_file_path.replace('\\', '\\\\')
+        subtitles_path = utils.purify_path(file_path)
+        output_file_path = os.path.abspath(str(output_file_path))
+        output_args = EncodeVideoMP4.output_args if config['hardsubs'] else EncodeVideoMKV.output_args
+
+        ffmpeg_arguments = self.get_settings(subtitles_path, dict(output_args))
+        video_arguments = {
+            k: v for k, v in ffmpeg_arguments.items()
+            if k not in self.audio_args + self.container_args
+        }
+        audio_file_path = self.get_audio_file_path(ffmpeg_arguments)
+        audio_arguments = {
+            k: v for k, v in ffmpeg_arguments.items() if k in self.audio_args
+        }
+        self.cached = self.fetch_cached(ffmpeg_arguments)
+
+        if not self.cached:
+            self.encode(input_file_path, output_file_path, ffmpeg_arguments, video_arguments, audio_arguments, audio_file_path)
+
+        if not self.valid:
+            raise Exception(f'Episode file named {file_name} not encoded')
 
+        if not self.cached:
+            self.store_cached()
+
+        self.file_size = os.path.getsize(self.output_file_path)
+
+    def encode(self, input_file_path, output_file_path, ffmpeg_arguments, video_arguments, audio_arguments, audio_file_path):
         utils.check_and_delete(output_file_path)
 
-        stream = ffmpeg.input(file_path)
-        stream = ffmpeg.output(
-            stream.video, stream.audio, output_file_path, **ffmpeg_arguments
+        work_dir_path = self.get_work_dir
+        try:
+            chunk_commands = []
+            for i, (start, end) in enumerate(self.get_chunks(input_file_path)):
+                chunk_file_path = os.path.join(work_dir_path, '{}.mkv'.format(str(i).zfill(4)))
+                # Both bounds trim the decoded frames, so neighbouring chunks
+                # meet exactly at their shared cut.
+                chunk_commands.append([
+                    'ffmpeg', '-y', '-ss', str(start),
+                    *(['-to', str(end)] if end is not None else []),
+                    '-i', input_file_path,
+                    '-map', '0:v:0', '-an', '-sn', '-dn',
+                    *self.get_output_args(video_arguments),
+                    '-f', 'matroska', chunk_file_path,
+                ])
+
+            # Every chunk is its own ffmpeg process, so threads are enough to
+            # keep them all busy and still work inside daemonic celery workers.
+            self.chunks_progress = {}
+            self.chunks_count = len(chunk_commands)
+            self.progress_lock = threading.Lock()
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                chunk_file_paths = list(executor.map(self.encode_chunk, range(len(chunk_commands)), chunk_commands))
+
+            concat_file_path = os.path.join(work_dir_path, 'chunks.txt')
+            with open(concat_file_path, 'w') as concat_file:
+                concat_file.writelines(f"file '{p}'\n" for p in chunk_file_paths)
+
+            # The concatenated chunks start at 0, the audio and subtitles of
+            # the source keep where they start relative to its video.
+            video_offset, audio_offset = self.get_start_offsets(input_file_path)
+
+            input_args = ['-i', input_file_path]
+            stream_args = ['-map', '0:v', '-map', '1:a']
+            if not self.is_source_audio(audio_file_path):
+                # Read on its own, the audio file starts at 0 as well.
+                input_args.extend(['-itsoffset', str(audio_offset), '-i', audio_file_path])
+                stream_args = ['-map', '0:v', '-map', '2:a']
+            if ffmpeg_arguments['f'] == 'matroska':
+                stream_args.extend([
+                    '-map', '1:s?', '-map', '1:t?', '-c:s', 'copy', '-c:t', 'copy'
+                ])
+
+            subprocess.run([
+                'ffmpeg', '-y', '-itsoffset', str(video_offset),
+                '-f', 'concat', '-safe', '0', '-i', concat_file_path,
+                *input_args, *stream_args, '-c:v', 'copy',
+                *self.get_output_args(audio_arguments),
+                '-f', ffmpeg_arguments['f'], output_file_path,
+            ], check=True)
+        finally:
+            utils.check_and_delete_dir(work_dir_path)
+
+    def encode_chunk(self, chunk_index, ffmpeg_command):
+        self.run(ffmpeg_command, lambda progress: self.set_chunk_progress(chunk_index, progress))
+        return ffmpeg_command[-1]
+
+    def set_chunk_progress(self, chunk_index, progress):
+        progress_callback = self.config.get('progress_callback')
+        if not progress_callback:
+            return
+
+        # Chunks run side by side, so their frames and time add up, and so
+        # does the speed of the ones still running.
+        with self.progress_lock:
+            self.chunks_progress[chunk_index] = progress
+            finished = [p.get('progress') == 'end' for p in self.chunks_progress.values()]
+            total_progress = {
+                'progress': 'end' if len(finished) == self.chunks_count and all(finished) else 'continue',
+                'bitrate': progress.get('bitrate'),
+            }
+            for key in ('frame', 'out_time_us'):
+                total_progress[key] = sum(
+                    utils.to_float(p.get(key)) for p in self.chunks_progress.values()
+                )
+            for key in ('fps', 'speed'):
+                total_progress[key] = sum(
+                    utils.to_float(p.get(key)) for p in self.chunks_progress.values()
+                    if p.get('progress') != 'end' or total_progress['progress'] == 'end'
+                )
+            progress_callback(total_progress)
+
+    def get_chunks(self, file_path):
+        chunk_seconds = getattr(settings, 'ENCODE_CHUNK_SECONDS', 60)
+        file_info = ffmpeg.probe(
+            file_path, select_streams='v:0', show_entries='packet=pts_time,flags'
+        )
+        start_time = float(file_info['format'].get('start_time', 0))
+
+        # Source keyframes sit on scene cuts, so cutting there keeps every
+        # chunk starting on a clean scene and seeking cheap.
+        frames = sorted(
+            (float(p['pts_time']) - start_time, 'K' in p.get('flags', ''))
+            for p in file_info['packets'] if 'pts_time' in p
+        )
+
+        # Cut halfway between a keyframe and the frame shown before it. No
+        # frame sits near the cut, so the rounding of the printed timestamps
+        # can neither duplicate nor drop one.
+        cuts = [0]
+        for (previous_pts, _), (pts, keyframe) in zip(frames, frames[1:]):
+            if keyframe and pts - cuts[-1] >= chunk_seconds:
+                cuts.append((previous_pts + pts) / 2)
+
+        return list(zip(cuts, cuts[1:] + [None]))
+
+    def get_start_offsets(self, file_path):
+        file_info = ffmpeg.probe(file_path)
+        start_time = float(file_info['format'].get('start_time', 0))
+
+        def get_offset(codec_type):
+            for stream in file_info['streams']:
+                if stream.get('codec_type') == codec_type and 'start_time' in stream:
+                    return max(0, float(stream['start_time']) - start_time)
+            return 0
+
+        return get_offset('video'), get_offset('audio')
+
+    @property
+    def workers(self):
+        return getattr(settings, 'ENCODE_CHUNK_WORKERS', max(1, os.cpu_count() // 4))
+
+    @property
+    def get_work_dir(self):
+        dir_name = str(uuid.uuid4())
+        base_dir_path = utils.create_and_get_path(
+            os.path.join(settings.BASE_DIR, 'chunks')
         )
-        stream = ffmpeg.overwrite_output(stream)
-        ffmpeg.run(stream)
+        return utils.create_and_get_path(
+            os.path.join(base_dir_path, dir_name)
+        )
+
+
+class EncodeVideoRemux(BaseEncoder):
+
+    def __init__(self, file_path, output_file_path, config):
+        super(EncodeVideoRemux, self).__init__()
+        self.config = config
+        self.source_file_path = file_path
+        self.output_file_path = output_file_path
+        self.cached = False
+        file_name = os.path.basename(file_path)
+        input_file_path = os.path.abspath(str(file_path))
+        output_file_path = os.path.abspath(str(output_file_path))
+        output_args = EncodeVideoMP4.output_args if config['hardsubs'] else EncodeVideoMKV.output_args
+
+        audio_bitrate = self.resolution_settings(config['resolution'], config['crf'])[0]
+        ffmpeg_arguments = {'c:a': 'aac', 'b:a': audio_bitrate}
+        audio_file_path = self.get_audio_file_path(ffmpeg_arguments)
+
+        input_args = ['-i', input_file_path]
+        stream_args = ['-map', '0:v:0', '-map', '0:a']
+        if not self.is_source_audio(audio_file_path):
+            input_args.extend(['-i', audio_file_path])
+            stream_args = ['-map', '0:v:0', '-map', '1:a']
+        elif EncodeAudio.can_remux(probes.MediaProbe(input_file_path), audio_bitrate):
+            ffmpeg_arguments = {'c:a': 'copy'}
+
+        if output_args['f'] == 'matroska':
+            stream_args.extend(['-map', '0:s?', '-map', '0:t?', '-c:s', 'copy', '-c:t', 'copy'])
+        else:
+            # Apple players only pick up HEVC in mp4 with the hvc1 tag.
+            stream_args.extend(['-tag:v', 'hvc1'])
+
+        utils.check_and_delete(output_file_path)
+        self.run([
+            'ffmpeg', '-y', *input_args, *stream_args, '-c:v', 'copy',
+            *self.get_output_args(ffmpeg_arguments),
+            '-metadata', 'Yugen', '-f', output_args['f'], output_file_path,
+        ])
 
         if not self.valid:
-            raise Exception(f'Episode file named {file_name} not encoded')
+            raise Exception(f'Episode file named {file_name} not remuxed')
 
         self.file_size = os.path.getsize(self.output_file_path)
 
+    @staticmethod
+    def accepts(file_info, config):
+        # Interlaced sources still need yadif, smartblur is only worth its
+        # cost on sources that get re-encoded anyway.
+        if config['deinterlace']:
+            return False
+
+        max_bit_rate = getattr(settings, 'ENCODE_REMUX_MAX_BITRATE', {
+            1080: 3500000,
+            720: 2000000,
+            480: 1000000,
+        }).get(config['resolution'])
+
+        return bool(max_bit_rate) and \
+            file_info.video_codec == 'HEVC' and \
+            file_info.height == config['resolution'] and \
+            file_info.bit_depth == 8 and \
+            file_info.video_track.get('chroma_subsampling') == '4:2:0' and \
+            0 < file_info.video_bit_rate <= max_bit_rate
+
+
+class PresetPolicy:
+
+    # x265 presets from the quality profile to the fastest one allowed, with
+    # their speed relative to slow and the CRF change that roughly makes up
+    # for the efficiency they lose.
+    presets = (
+        ('slow', 1.0, 0),
+        ('medium', 2.2, -1),
+        ('fast', 2.8, -1),
+        ('faster', 3.6, -2),
+        ('veryfast', 4.5, -3),
+    )
+
+    def __init__(self, backlog_seconds, measured_speeds):
+        self.backlog_seconds = backlog_seconds
+        self.measured_speeds = measured_speeds
+        self.sla = getattr(settings, 'ENCODE_SLA', 6 * 60 * 60)
+
+    @property
+    def base_speed(self):
+        # Every measured preset gives an estimate of the slow preset speed.
+        relative_speeds = {preset: speed for preset, speed, _ in self.presets}
+        estimates = [
+            speed / relative_speeds[preset]
+            for preset, speed in self.measured_speeds.items() if preset in relative_speeds and speed
+        ]
+        return sum(estimates) / len(estimates) if estimates else None
+
+    def select(self):
+        base_speed = self.base_speed
+        if not base_speed:
+            return self.presets[0][0], self.presets[0][2]
+
+        for preset, relative_speed, crf_offset in self.presets:
+            speed = self.measured_speeds.get(preset) or base_speed * relative_speed
+            if self.backlog_seconds / speed <= self.sla:
+                return preset, crf_offset
+
+        return self.presets[-1][0], self.presets[-1][2]
+
+
+class EncodeCache:
+
+    def __init__(self):
+        self.cache_dir_path = utils.create_and_get_path(getattr(
+            settings, 'ENCODE_CACHE_DIR', os.path.join(settings.BASE_DIR, 'encode_cache')
+        ))
+        self.max_size = getattr(settings, 'ENCODE_CACHE_MAX_SIZE', 100 * 1024 ** 3)
+
+    @staticmethod
+    def get_key(source_hash, resolution, ffmpeg_arguments):
+        if not source_hash or not getattr(settings, 'ENCODE_CACHE', True):
+            return None
+
+        arguments_hash = hashlib.sha1(
+            json.dumps(ffmpeg_arguments, sort_keys=True, default=str).encode('utf8')
+        ).hexdigest()
+        return hashlib.sha1(
+            f'{source_hash}:{resolution}:{arguments_hash}'.encode('utf8')
+        ).hexdigest()
+
+    def get_path(self, cache_key):
+        return os.path.join(self.cache_dir_path, cache_key)
+
+    def fetch(self, cache_key, output_file_path):
+        if not cache_key:
+            return False
+
+        cache_file_path = self.get_path(cache_key)
+        if not os.path.exists(cache_file_path):
+            return False
+
+        # The modification time is the recency used for eviction.
+        os.utime(cache_file_path)
+        utils.check_and_delete(output_file_path)
+        utils.link_or_copy(cache_file_path, output_file_path)
+        return True
+
+    def store(self, cache_key, output_file_path):
+        if not cache_key:
+            return
+
+        cache_file_path = self.get_path(cache_key)
+        temp_file_path = f'{cache_file_path}.{uuid.uuid4()}'
+        utils.link_or_copy(output_file_path, temp_file_path)
+        os.replace(temp_file_path, cache_file_path)
+        os.utime(cache_file_path)
+
+        # The encode is done and cached, trimming the cache must not fail it.
+        try:
+            self.evict()
+        except OSError:
+            traceback.print_exc()
+
+    def evict(self):
+        cache_files = []
+        for file_name in os.listdir(self.cache_dir_path):
+            # Keys are plain hex, dotted names are other workers' stores
+            # still being written.
+            if '.' in file_name:
+                continue
+            try:
+                file_stat = os.stat(os.path.join(self.cache_dir_path, file_name))
+            except FileNotFoundError:
+                # Replaced or evicted by another worker meanwhile.
+                continue
+            cache_files.append((file_stat.st_mtime, file_stat.st_size, file_name))
+
+        total_size = sum(size for _, size, _ in cache_files)
+        for _, size, file_name in sorted(cache_files):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir_path, file_name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+
+class EncodeAudio:
+
+    def __init__(self, file_path, audio_bitrates):
+        started_at = time.time()
+        self.output_dir_path = self.get_output_dir
+        input_file_path = os.path.abspath(str(file_path))
+        file_info = probes.MediaProbe(input_file_path)
+
+        self.output_file_paths, output_args = {}, []
+
+        for audio_bitrate in sorted(set(audio_bitrates)):
+            if self.can_remux(file_info, audio_bitrate):
+                self.output_file_paths[audio_bitrate] = input_file_path
+                continue
+
+            output_file_path = os.path.join(self.output_dir_path, f'{audio_bitrate}.mka')
+            output_args.extend([
+                '-map', '0:a', '-c:a', 'aac', '-b:a', audio_bitrate,
+                '-f', 'matroska', output_file_path,
+            ])
+            self.output_file_paths[audio_bitrate] = output_file_path
+
+        # Every distinct audio profile is encoded once, from a single decode,
+        # and muxed as is into each rendition that uses it.
+        if output_args:
+            subprocess.run(['ffmpeg', '-y', '-i', input_file_path, *output_args], check=True)
+
+        self.elapsed = time.time() - started_at
+
+    @staticmethod
+    def can_remux(file_info, audio_bitrate):
+        audio_budget = int(audio_bitrate.rstrip('k')) * 1000
+        return bool(file_info.audio_tracks) and all(
+            t.get('format') == 'AAC' and str(t.get('bit_rate') or '').isdigit() and
+            int(t['bit_rate']) <= audio_budget
+            for t in file_info.audio_tracks
+        )
+
+    @property
+    def get_output_dir(self):
+        dir_name = str(uuid.uuid4())
+        base_dir_path = utils.create_and_get_path(
+            os.path.join(settings.BASE_DIR, 'audio')
+        )
+        return utils.create_and_get_path(
+            os.path.join(base_dir_path, dir_name)
+        )
+
 
 class GenerateScreenshots:
 
-    def __init__(self, file_path, subtype):
+    def __init__(self, file_path, subtype, count=6):
+        started_at = time.time()
         self.output_dir_path = self.get_output_dir
         ofile_path = str(file_path)
-        file_name = os.path.basename(file_path)
-        file_path = os.path.abspath(str(file_path)).replace('\\', '\\\\')
-        subtitles_path = utils.purify_path(file_path)
+        input_file_path = os.path.abspath(str(file_path))
 
-        file_info = MediaInfo.parse(filename=ofile_path)
-        total_frames = int(file_info.video_tracks[0].frame_count)
+        file_info = probes.MediaProbe(ofile_path)
+        total_frames = file_info.frame_count
+        frame_duration = file_info.duration / total_frames
         output_files, random_times = [], []
 
-        for i in range(6):
+        for i in range(count):
             random_time = random.randint(24, total_frames-24)
             while random_time in random_times:
                 random_time = random.randint(24, total_frames-24)
@@ -197,28 +822,37 @@ class GenerateScreenshots:
 
         random_times = sorted(random_times)
 
+        subtitles_filter = None
+        if subtype == 'softsubs':
+            subtitles_filter = self.extract_subtitles(input_file_path)
+
+        # Every screenshot is its own input with an input side seek, so ffmpeg
+        # only decodes from the nearest keyframe instead of from frame 0, and
+        # all of them come out of a single invocation.
+        input_args, output_args, filter_graph = [], [], []
         for i, t in enumerate(random_times):
             output_file_name = '{}.jpg'.format(str(i).zfill(2))
-            output_file_path = os.path.join(
-                self.output_dir_path, output_file_name)
-            stream = ffmpeg.input(file_path)
-            vf_args = [f'select=eq(n\,{t})']
+            input_args.extend(['-ss', '%.3f' % (t * frame_duration), '-i', input_file_path])
 
-            if subtype == 'softsubs':
-                vf_args.append(f'subtitles=\'{subtitles_path}\'')
+            stream_label = f'{i}:v:0'
+            if subtitles_filter:
+                filter_graph.append(f'[{stream_label}]{subtitles_filter}[v{i}]')
+                stream_label = f'[v{i}]'
 
-            stream = ffmpeg.output(
-                stream.video,
-                output_file_path.replace('\\', '\\\\'),
-                **{
-                    'vf': ','.join(vf_args),
-                    'vframes': 1,
-                    'q:v': 2,
-                }
-            )
-            stream = ffmpeg.overwrite_output(stream)
-            ffmpeg.run(stream)
+            output_args.extend([
+                '-map', stream_label, '-frames:v', '1', '-q:v', '2',
+                os.path.join(self.output_dir_path, output_file_name),
+            ])
+
+        if filter_graph:
+            input_args.extend(['-filter_complex', ';'.join(filter_graph)])
 
+        subprocess.run(['ffmpeg', '-y', '-copyts', *input_args, *output_args], check=True)
+
+        for i in range(len(random_times)):
+            output_file_name = '{}.jpg'.format(str(i).zfill(2))
+            output_file_path = os.path.join(
+                self.output_dir_path, output_file_name)
             output_files.append(
                 (output_file_name, BytesIO(open(output_file_path, 'rb').read()))
             )
@@ -226,6 +860,24 @@ class GenerateScreenshots:
         utils.check_and_delete_dir(self.output_dir_path)
 
         self.output_files = output_files
+        self.elapsed = time.time() - started_at
+
+    def extract_subtitles(self, file_path):
+        fonts_dir_path = utils.create_and_get_path(
+            os.path.join(self.output_dir_path, 'fonts')
+        )
+        subtitles_file_path = os.path.join(self.output_dir_path, 'subtitles.ass')
+
+        # One demux pass pulls the subtitles and their fonts out of the
+        # container, so the subtitles filters don't each reread the file.
+        subprocess.run([
+            'ffmpeg', '-y', '-dump_attachment:t', '', '-i', file_path,
+            '-map', '0:s:0', '-c:s', 'ass', subtitles_file_path,
+        ], check=True, cwd=fonts_dir_path)
+
+        return 'subtitles=\'{}\':fontsdir=\'{}\''.format(
+            utils.purify_path(subtitles_file_path), utils.purify_path(fonts_dir_path)
+        )
 
     @property
     def get_output_dir(self):
@@ -1,23 +1,268 @@
+import io
 import os
 import time
+import traceback
+import shutil
+import threading
 from io import BytesIO
+from collections import Counter
 from django.conf import settings
 
 import qbittorrentapi
 from qbittorrentapi.definitions import TorrentStates
+from qbittorrentapi.torrents import TorrentDictionary
 from torrentool.api import Torrent
 
-from core import models, utils
+from core import models, utils, torrents
+
+class CountedClient:
+    """Counts the API calls one download makes through the pooled client."""
+
+    def __init__(self, qbt_client):
+        self.qbt_client = qbt_client
+        self.api_calls = Counter()
+
+    def __getattr__(self, name):
+        attr = getattr(self.qbt_client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            self.api_calls[name] += 1
+            return attr(*args, **kwargs)
+        return call
+
+# Clients are shared by every download of a worker process, so the session
+# is logged in once instead of once per download. The library logs in again
+# on its own when the session expires.
+qbt_clients = {}
+qbt_clients_lock = threading.Lock()
+
+def get_qbt_client(qbt_obj=None):
+    qbt_obj = qbt_obj or models.QBitTorrent.objects.filter(enabled=True).first()
+    if not qbt_obj:
+        raise Exception('No QBitTorrent found')
+
+    key = (qbt_obj.host, qbt_obj.port, qbt_obj.username, qbt_obj.password)
+    with qbt_clients_lock:
+        qbt_client = qbt_clients.get(key)
+        if not qbt_client:
+            qbt_client = qbt_clients[key] = qbittorrentapi.Client(
+                host=qbt_obj.host, port=qbt_obj.port, username=qbt_obj.username, password=qbt_obj.password)
+
+        if not qbt_client.is_logged_in:
+            try:
+                qbt_client.auth_log_in()
+            except qbittorrentapi.LoginFailed as e:
+                raise Exception(e.message)
+
+    return qbt_client
+
+class TorrentStateCache:
+    """
+    Mirror of every torrent in a qBittorrent instance, kept current through
+    the rid based sync/maindata API. Each sync only transfers the fields
+    that changed since the previous one.
+    """
+
+    def __init__(self):
+        self.rid = 0
+        self.torrents = {}
+        self.server_state = {}
+        self.synced_at = 0
+        self.lock = threading.Lock()
+
+    def sync(self, qbt_client, force=False):
+        with self.lock:
+            # Lookups made in a burst share one request.
+            if not force and time.time() - self.synced_at < getattr(settings, 'QBT_SYNC_INTERVAL', 1):
+                return
+
+            maindata = qbt_client.sync_maindata(rid=self.rid)
+
+            if maindata.get('full_update'):
+                self.torrents = {}
+                self.server_state = {}
+
+            self.server_state.update(maindata.get('server_state') or {})
+
+            for torrent_hash, changes in (maindata.get('torrents') or {}).items():
+                self.torrents.setdefault(torrent_hash, {'hash': torrent_hash}).update(changes)
+
+            for torrent_hash in maindata.get('torrents_removed') or []:
+                self.torrents.pop(torrent_hash, None)
+
+            self.rid = maindata.get('rid', self.rid)
+            self.synced_at = time.time()
+
+    def get(self, qbt_client, torrent_hash, force=False):
+        self.sync(qbt_client, force)
+        if torrent_hash not in self.torrents and not force:
+            # Might have been added since the last sync.
+            self.sync(qbt_client, force=True)
+        torrent_info = self.torrents.get(torrent_hash)
+        if torrent_info:
+            return TorrentDictionary(data=dict(torrent_info), client=qbt_client)
+
+torrent_state_caches = {}
+torrent_state_caches_lock = threading.Lock()
+
+def get_torrent_state_cache(qbt_obj):
+    with torrent_state_caches_lock:
+        return torrent_state_caches.setdefault((qbt_obj.host, qbt_obj.port), TorrentStateCache())
+
+def get_download_path(qbt_obj):
+    return utils.create_and_get_path(
+        qbt_obj.download_path or os.path.join(settings.BASE_DIR, 'downloads')
+    )
+
+def get_free_space(qbt_obj):
+    """
+    Free space of a backend's download disk, less what its downloads in
+    flight have yet to write.
+    """
+    qbt_client = get_qbt_client(qbt_obj)
+    torrent_state = get_torrent_state_cache(qbt_obj)
+    torrent_state.sync(qbt_client)
+
+    free_space = torrent_state.server_state.get('free_space_on_disk')
+    if free_space is None:
+        free_space = shutil.disk_usage(get_download_path(qbt_obj)).free
+
+    for torrent_hash in get_active_downloads(qbt_obj, torrent_state):
+        torrent_info = torrent_state.torrents.get(torrent_hash)
+        if torrent_info:
+            free_space -= torrent_info.get('amount_left', 0)
+
+    return free_space
+
+def get_active_downloads(qbt_obj, torrent_state):
+    """
+    Hashes of the downloads a backend is still fetching. Streamed downloads
+    are processed while they arrive, so a 'proc' row holds its slot until
+    it is removed from qBittorrent.
+    """
+    return [
+        torrent_hash for status, torrent_hash in qbt_obj.pending_downloads.filter(
+            status__in=['dl', 'proc']
+        ).values_list('status', 'torrent_hash')
+        if status == 'dl' or torrent_hash in torrent_state.torrents
+    ]
+
+def pick_qbittorrent(file_size=0):
+    """
+    The least loaded enabled backend with a free download slot and room for
+    file_size, or None when every backend is full.
+    """
+    candidates = []
+    for qbt_obj in models.QBitTorrent.objects.filter(enabled=True):
+        try:
+            free_space = get_free_space(qbt_obj)
+        except Exception:
+            traceback.print_exc()
+            continue
+
+        active_downloads = len(get_active_downloads(qbt_obj, get_torrent_state_cache(qbt_obj)))
+        if active_downloads >= qbt_obj.max_downloads:
+            continue
+
+        if free_space - file_size < qbt_obj.min_free_space * 1024 ** 3:
+            continue
+
+        candidates.append((active_downloads / qbt_obj.max_downloads, -free_space, qbt_obj.id, qbt_obj))
+
+    if candidates:
+        return min(candidates)[-1]
+
+def is_torrent_complete(qtorrent):
+    return int(qtorrent.progress * 100) == 100 and TorrentStates(qtorrent.state).is_complete
+
+def is_stream_ready(qtorrent):
+    # Single file torrents are named after their file, so this skips the
+    # torrents get_stream_reader would turn down. That one also waits for
+    # the first and last pieces, which hold what the source is probed for.
+    return qtorrent.get('progress', 0) > 0 and qtorrent.get('name', '').endswith('.mkv')
+
+class PieceReader(io.RawIOBase):
+    """
+    Reads the file of a torrent that is still downloading, blocking until the
+    pieces holding the requested bytes are complete. Pieces arrive in order
+    in sequential mode, so only the complete prefix is tracked.
+    """
+
+    def __init__(self, downloader, file_path, file_size, piece_length):
+        self.downloader = downloader
+        self.file_path = file_path
+        self.file_size = file_size
+        self.piece_length = piece_length
+        self.position = 0
+        self.complete_pieces = 0
+        self.file = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.position >= self.file_size:
+            return 0
+
+        self.wait_pieces(self.position // self.piece_length + 1)
+        size = min(
+            len(buffer),
+            self.file_size - self.position,
+            self.complete_pieces * self.piece_length - self.position
+        )
+
+        if not self.file:
+            self.file = open(self.file_path, 'rb')
+        self.file.seek(self.position)
+        read_size = self.file.readinto(memoryview(buffer)[:size])
+        self.position += read_size
+        return read_size
+
+    def wait_pieces(self, count):
+        must_end = time.time() + getattr(settings, 'DOWNLOAD_TIMEOUT', 60 * 60 * 24)
+        while self.complete_pieces < count:
+            if time.time() > must_end:
+                raise Exception('Timed out waiting for the pieces of {}'.format(self.file_path))
+
+            piece_states = self.downloader.qbt_client.torrents_piece_states(self.downloader.torrent_hash)
+
+            # 2 is downloaded and checked.
+            complete_pieces = 0
+            for piece_state in piece_states:
+                if piece_state != 2:
+                    break
+                complete_pieces += 1
+            self.complete_pieces = complete_pieces
+
+            if self.complete_pieces < count:
+                time.sleep(getattr(settings, 'DOWNLOAD_STREAM_POLL', 2))
+
+    def wait_complete(self):
+        if not utils.wait_state(self.downloader.func1, self.downloader.func2):
+            raise Exception('Timed out waiting for {}'.format(self.file_path))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        super(PieceReader, self).close()
+
+class NoBackendAvailable(Exception):
+    pass
 
 class BaseDownloader:
 
-    def __init__(self, magnet_url=None, torrent_file=None):
+    def __init__(self, magnet_url=None, torrent_file=None, torrent_hash=None, qbt_obj=None):
 
-        if not (magnet_url or torrent_file):
-            raise ValueError('Either magnet url or torrent file should be provided')
+        if not (magnet_url or torrent_file or torrent_hash):
+            raise ValueError('Either magnet url, torrent file or torrent hash should be provided')
 
         self.file_size = 0
-        if magnet_url:
+        if torrent_hash:
+            # Picks up a torrent that an earlier call already added.
+            self.torrent_hash = torrent_hash
+        elif magnet_url:
             self.magnet_url = magnet_url
             self.torrent_hash = utils.get_magnet_hash(self.magnet_url)
         else:
@@ -27,33 +272,26 @@ class BaseDownloader:
             self.file_name = self.torrent_file.files[0].name
             self.file_size = self.torrent_file.total_size
 
+        self.qbt_obj = qbt_obj
         self.prepare()
 
     def prepare(self):
-        qbt_obj = models.QBitTorrent.objects.all().first()
-        if not qbt_obj:
-            raise Exception('No QBitTorrent found')
+        if not self.qbt_obj:
+            self.qbt_obj = pick_qbittorrent(self.file_size)
+            if not self.qbt_obj:
+                raise NoBackendAvailable('No QBitTorrent with a free slot and enough disk space')
 
-        self.qbt_client = qbittorrentapi.Client(
-            host=qbt_obj.host, port=qbt_obj.port, username=qbt_obj.username, password=qbt_obj.password)
-
-        try:
-            self.qbt_client.auth_log_in()
-        except qbittorrentapi.LoginFailed as e:
-            raise Exception(e.message)
+        self.qbt_client = CountedClient(get_qbt_client(self.qbt_obj))
+        self.torrent_state = get_torrent_state_cache(self.qbt_obj)
 
     @property
     def qtorrent(self):
         if self.torrent_hash:
-            for t in self.qbt_client.torrents_info():
-                if self.torrent_hash == t.hash:
-                    return t
+            return self.torrent_state.get(self.qbt_client, self.torrent_hash)
 
     @property
     def download_path(self):
-        return utils.create_and_get_path(
-            os.path.join(settings.BASE_DIR, 'downloads')
-        )
+        return get_download_path(self.qbt_obj)
 
     def file_path(self, file_name=''):
         return os.path.join(self.download_path, file_name or self.file_name)
@@ -65,70 +303,122 @@ class BaseDownloader:
     def func2(self, progress, state):
         return int(progress * 100) == 100 and TorrentStates(state).is_complete
 
+    @property
+    def api_calls(self):
+        return self.qbt_client.api_calls
+
     def wait_state(self):
         utils.wait_state(self.func1, self.func2)
 
+    def is_complete(self):
+        qtorrent = self.qtorrent
+        return bool(qtorrent) and is_torrent_complete(qtorrent)
+
+    def add_trackers(self):
+        all_announce_urls = []
+        for track in models.Tracker.objects.all():
+            all_announce_urls.extend(track.get_trackers())
+        self.qtorrent.add_trackers(urls=all_announce_urls)
+
 class DownloadEpisode(BaseDownloader):
 
-    def download(self):
+    def get_add_options(self):
+        if not getattr(settings, 'DOWNLOAD_STREAM_INGEST', False):
+            return {}
+        # The encode reads the file front to back, and the container
+        # headers and cues sit in the first and last pieces.
+        return {
+            'is_sequential_download': True,
+            'is_first_last_piece_priority': True,
+        }
+
+    def start(self):
         qb_response = self.qbt_client.torrents_add(
             torrent_files=BytesIO(self.torrent_bytes),
-            save_path=self.download_path
+            save_path=self.download_path,
+            **self.get_add_options()
         )
 
-        if qb_response != 'Ok.':
+        # qBittorrent turns down a torrent it already has, which is as good
+        # as started.
+        if qb_response != 'Ok.' and not self.qtorrent:
             raise Exception(
                 'Error starting download of torrent\n%s' % qb_response)
 
         time.sleep(3)
 
-        all_announce_urls = []
-        for track in models.Tracker.objects.all():
-            all_announce_urls.extend(track.get_trackers())
-        self.qtorrent.add_trackers(urls=all_announce_urls)
-
-        self.wait_state()
-
-        self.qtorrent.delete(False)
-
-        return {
-            'file_name': self.file_name,
-            'file_path': self.file_path(),
-            'file_size': self.file_size,
-        }
+        self.add_trackers()
 
-    def download_from_magnet(self):
+    def start_from_magnet(self):
         qb_response = self.qbt_client.torrents_add(
             urls=self.magnet_url,
-            save_path=self.download_path
+            save_path=self.download_path,
+            **self.get_add_options()
         )
 
-        if qb_response != 'Ok.':
+        if qb_response != 'Ok.' and not self.qtorrent:
             raise Exception(
                 'Error starting download of torrent\n%s' % qb_response)
 
         time.sleep(3)
 
-        self.file_name = self.qtorrent['name']
-        self.file_size = self.qtorrent['total_size']
-
-        all_announce_urls = []
-        for track in models.Tracker.objects.all():
-            all_announce_urls.extend(track.get_trackers())
-        self.qtorrent.add_trackers(urls=all_announce_urls)
-
-        self.wait_state()
+        self.add_trackers()
 
-        self.qtorrent.delete(False)
+    def get_file_info(self):
+        qtorrent = self.qtorrent
+        self.file_name = qtorrent['name']
+        self.file_size = qtorrent['total_size']
 
         return {
             'file_name': self.file_name,
             'file_path': self.file_path(),
             'file_size': self.file_size,
+            'qbittorrent': self.qbt_obj,
         }
 
+    def finish(self):
+        file_info = self.get_file_info()
+        self.qtorrent.delete(False)
+        return file_info
+
+    def get_stream_reader(self):
+        # Only a single matroska file can be demuxed from a pipe as it
+        # arrives, mp4 sources usually keep their index at the end.
+        files = self.qbt_client.torrents_files(self.torrent_hash)
+        if len(files) != 1 or not files[0]['name'].endswith('.mkv'):
+            return None
+
+        # Until the headers and cues are in, a probe of the file would only
+        # see zeros and get the subtitles, duration and container wrong.
+        piece_states = self.qbt_client.torrents_piece_states(self.torrent_hash)
+        if not piece_states or piece_states[0] != 2 or piece_states[-1] != 2:
+            return None
+
+        properties = self.qbt_client.torrents_properties(self.torrent_hash)
+        return PieceReader(self, self.file_path(files[0]['name']), files[0]['size'], properties['piece_size'])
+
+    def download(self):
+        self.start()
+        self.wait_state()
+        return self.finish()
+
+    def download_from_magnet(self):
+        self.start_from_magnet()
+        self.wait_state()
+        return self.finish()
+
 class DownloadBatch(BaseDownloader):
 
+    def prepare(self):
+        # Listing the files needs no backend, one is only picked once there
+        # is something to download.
+        if self.qbt_obj:
+            super(DownloadBatch, self).prepare()
+
+    def connect(self):
+        if not hasattr(self, 'qbt_client'):
+            super(DownloadBatch, self).prepare()
+
     def get_data(self):
         data = []
         for f in self.qtorrent.files:
@@ -142,21 +432,100 @@ class DownloadBatch(BaseDownloader):
         return data
 
     def get_info(self):
+        # Read straight from the .torrent, adding it to qBittorrent only to
+        # list its files would announce it and allocate it on disk.
+        files = torrents.get_files(self.torrent_file)
+
+        if len(files) <= 1:
+            return []
+
+        # Where the files land is only known once a backend is picked.
+        data = [{
+            'file_name': name,
+            'file_path': self.file_path(name) if self.qbt_obj else None,
+            'file_size': size,
+        } for name, size in files]
+
+        return sorted(data, key=lambda x: x['file_name'])
+
+    def get_missing_files(self, anime_obj, resolution):
+        missing = []
+        for f in self.get_info():
+            if not f['file_name'].endswith(('.mkv', '.mp4')):
+                continue
+
+            try:
+                _, episode_name, _, _ = utils.extract_names(
+                    os.path.basename(f['file_name']), anime_obj.title, anime_obj.get_alt_names())
+            except IndexError:
+                episode_name = None
+
+            # Files we cannot name are downloaded, skipping an episode we
+            # don't have is worse than fetching one twice.
+            if episode_name and models.Episode.objects.filter(
+                anime=anime_obj, resolution=resolution, name__icontains=episode_name
+            ).exists():
+                continue
+
+            missing.append(f)
+
+        return missing
+
+    def download_files(self, file_names):
+        file_names = set(file_names)
+        if not file_names:
+            return []
+
+        # Placed where the wanted files fit, not the whole batch.
+        self.file_size = sum(f['file_size'] for f in self.get_info() if f['file_name'] in file_names)
+        self.connect()
+
+        # Added paused so no piece of a skipped file is fetched before the
+        # priorities are in place.
         qb_response = self.qbt_client.torrents_add(
             torrent_files=BytesIO(self.torrent_bytes),
-            save_path=self.download_path
+            save_path=self.download_path,
+            is_paused=True
         )
-        self.qtorrent.pause()
 
-        if len(self.qtorrent.files) <= 1:
-            return []
+        if qb_response != 'Ok.':
+            raise Exception(
+                'Error starting download of torrent\n%s' % qb_response)
 
-        data = self.get_data()
+        time.sleep(3)
 
-        self.qtorrent.delete(True)
-        return sorted(data, key=lambda x: x['file_name'])
+        skipped_ids = []
+        for file_id, f in enumerate(self.qbt_client.torrents_files(torrent_hash=self.torrent_hash)):
+            name = f['name'].strip().replace('{}/'.format(self.qtorrent.name), '')
+            if name not in file_names:
+                skipped_ids.append(f.get('index', file_id))
+
+        if skipped_ids:
+            self.qbt_client.torrents_file_priority(
+                torrent_hash=self.torrent_hash,
+                file_ids=skipped_ids,
+                priority=0
+            )
+
+        self.add_trackers()
+        self.qtorrent.resume()
+
+        self.wait_state()
+
+        data = [f for f in self.get_data() if f['file_name'] in file_names]
+
+        self.qtorrent.delete(False)
+
+        return data
+
+    def download_missing(self, anime_obj, resolution):
+        return self.download_files([
+            f['file_name'] for f in self.get_missing_files(anime_obj, resolution)
+        ])
 
     def download(self):
+        self.connect()
+
         qb_response = self.qbt_client.torrents_add(
             torrent_files=BytesIO(self.torrent_bytes),
             save_path=self.download_path
@@ -182,9 +551,11 @@ class DownloadBatch(BaseDownloader):
         return data
 
     def download_from_magnet(self):
+        self.connect()
+
         qb_response = self.qbt_client.torrents_add(
             urls=self.magnet_url,
-            save_path=DL_PATH
+            save_path=self.download_path
         )
 
         if qb_response != 'Ok.':
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import platform
+import subprocess
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import models, encoders, probes, utils
+
+ASS_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: 1920
+PlayResY: 1080
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,64,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,0,0,0,0,100,100,0,0,1,3,1,2,40,40,60,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+
+class Command(BaseCommand):
+    help = 'Encode deterministic synthetic clips with every encoder, resolution and anime profile and print the timings as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=int, default=30, help='Clip length in seconds')
+        parser.add_argument('--source', choices=['testsrc2', 'mandelbrot'], default='testsrc2')
+        parser.add_argument('--resolutions', type=int, nargs='+', default=[1080, 720, 480])
+        parser.add_argument('--encoders', nargs='+', choices=['EncodeVideoMKV', 'EncodeVideoMP4'],
+                            default=['EncodeVideoMKV', 'EncodeVideoMP4'])
+        parser.add_argument('--anime', nargs='+', default=[],
+                            help='Anime titles to take the profiles from, all distinct profiles by default')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        work_dir_path = utils.create_and_get_path(os.path.join(settings.BASE_DIR, 'benchmark'))
+        clip_file_path = self.generate_clip(work_dir_path, options['source'], options['duration'])
+
+        results = []
+        for profile_name, profile in self.get_profiles(options['anime']):
+            for encoder_name in options['encoders']:
+                for resolution in options['resolutions']:
+                    output_file_path = os.path.join(
+                        work_dir_path, f'{encoder_name}.{resolution}.{profile_name}.out'
+                    )
+                    result = self.run_case(encoder_name, clip_file_path, output_file_path, {
+                        **profile,
+                        'resolution': resolution,
+                        # The mp4 encoder is only used for sources without
+                        # subtitles, as in handle_feed.
+                        'hardsubs': encoder_name == 'EncodeVideoMP4',
+                        'deinterlace': False,
+                    })
+                    result.update({'encoder': encoder_name, 'resolution': resolution, 'profile': profile_name})
+                    results.append(result)
+                    self.stderr.write(json.dumps(result))
+                    utils.check_and_delete(output_file_path)
+
+        report = json.dumps({
+            'commit': self.get_commit(),
+            'ffmpeg': self.get_ffmpeg_version(),
+            'machine': {
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'cpu_count': os.cpu_count(),
+            },
+            'clip': {'source': options['source'], 'duration': options['duration']},
+            'results': results,
+        }, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
+
+    def get_profiles(self, titles):
+        anime_objs = models.Anime.objects.all()
+        if titles:
+            anime_objs = anime_objs.filter(title__in=titles)
+
+        profiles = {}
+        for anime_obj in anime_objs:
+            profile = anime_obj.get_settings()
+            profiles.setdefault(json.dumps(profile, sort_keys=True), (anime_obj.title, profile))
+
+        if not profiles:
+            profiles['default'] = ('default', models.Anime().get_settings())
+
+        return list(profiles.values())
+
+    def generate_clip(self, work_dir_path, source, duration):
+        clip_file_path = os.path.join(work_dir_path, f'{source}.{duration}.mkv')
+        if os.path.exists(clip_file_path):
+            return clip_file_path
+
+        subtitles_file_path = os.path.join(work_dir_path, f'{duration}.ass')
+        with open(subtitles_file_path, 'w') as f:
+            f.write(ASS_HEADER)
+            for start in range(0, duration, 2):
+                f.write('Dialogue: 0,{},{},Default,,0,0,0,,Line {} of the benchmark clip\n'.format(
+                    self.ass_time(start), self.ass_time(start + 1.5), start // 2 + 1
+                ))
+
+        video_source = {
+            'testsrc2': 'testsrc2=size=1920x1080:rate=24000/1001',
+            'mandelbrot': 'mandelbrot=size=1920x1080:rate=24000/1001',
+        }[source]
+
+        # The seeded noise stands in for grain, which is what the x265
+        # psy and aq settings spend most of their bits on.
+        subprocess.run([
+            'ffmpeg', '-y',
+            '-f', 'lavfi', '-i', f'{video_source},noise=alls=12:allf=t:all_seed=1',
+            '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+            '-i', subtitles_file_path,
+            '-map', '0:v', '-map', '1:a', '-map', '2:s',
+            '-t', str(duration),
+            '-c:v', 'libx264', '-preset', 'veryfast', '-crf', '12', '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac', '-b:a', '192k', '-ac', '2',
+            '-c:s', 'ass',
+            '-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact',
+            clip_file_path
+        ], check=True)
+
+        return clip_file_path
+
+    def run_case(self, encoder_name, clip_file_path, output_file_path, config):
+        # Every case runs in its own child so that the peak RSS and CPU time
+        # reported by wait4 belong to that case alone.
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(read_fd)
+            result = {}
+            try:
+                result = self.encode(encoder_name, clip_file_path, output_file_path, config)
+            except Exception as e:
+                result = {'error': repr(e)}
+            finally:
+                with os.fdopen(write_fd, 'w') as f:
+                    f.write(json.dumps(result))
+                os._exit(0)
+
+        os.close(write_fd)
+        with os.fdopen(read_fd) as f:
+            result = json.loads(f.read() or '{}')
+        _, _, rusage = os.wait4(pid, 0)
+
+        result.update({
+            'cpu_user': round(rusage.ru_utime, 2),
+            'cpu_system': round(rusage.ru_stime, 2),
+            'peak_rss': rusage.ru_maxrss * 1024,
+        })
+        return result
+
+    def encode(self, encoder_name, clip_file_path, output_file_path, config):
+        progress = {}
+        config['progress_callback'] = progress.update
+
+        started_at = time.time()
+        encoder = getattr(encoders, encoder_name)(clip_file_path, output_file_path, config)
+        wall = time.time() - started_at
+
+        frame_count = probes.MediaProbe(output_file_path).frame_count
+        return {
+            'wall': round(wall, 2),
+            'fps': round(frame_count / wall, 2) if wall else 0,
+            'frames': frame_count,
+            'size': encoder.file_size,
+            'bitrate': progress.get('bitrate'),
+        }
+
+    def ass_time(self, seconds):
+        return '{}:{:02d}:{:05.2f}'.format(int(seconds // 3600), int(seconds % 3600 // 60), seconds % 60)
+
+    def get_commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+                capture_output=True, universal_newlines=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def get_ffmpeg_version(self):
+        return subprocess.run(
+            ['ffmpeg', '-version'], capture_output=True, universal_newlines=True
+        ).stdout.split('\n')[0]
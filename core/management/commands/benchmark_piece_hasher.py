@@ -0,0 +1,88 @@
+import os
+import json
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from torrentool.api import Torrent
+
+from core import torrents, utils
+
+
+class Command(BaseCommand):
+    help = 'Hash a synthetic batch directory with torrentool and the parallel hasher and print the timings as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=float, default=4, help='Total size of the directory in GiB')
+        parser.add_argument('--files', type=int, default=12)
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+        parser.add_argument('--skip-torrentool', action='store_true')
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic directory for the next run')
+
+    def handle(self, *args, **options):
+        batch_path = self.generate_batch(options['size'], options['files'])
+
+        try:
+            target_files, total_size = Torrent._get_target_files_info(Path(batch_path))
+            files = [(file_path, file_size) for file_path, file_size, _ in target_files]
+            results = []
+
+            reference_pieces = None
+            if not options['skip_torrentool']:
+                started_at = time.time()
+                reference_pieces = Torrent.create_from(batch_path)._struct['info']['pieces']
+                results.append(self.get_result('torrentool', None, torrents.PIECE_LENGTH, total_size, started_at))
+
+            for piece_length in sorted({torrents.PIECE_LENGTH, torrents.get_piece_length(total_size)}):
+                for workers in options['workers']:
+                    started_at = time.time()
+                    pieces = torrents.ParallelPieceHasher(files, piece_length, workers).hash()
+                    result = self.get_result('parallel', workers, piece_length, total_size, started_at)
+                    if reference_pieces is not None and piece_length == torrents.PIECE_LENGTH:
+                        result['matches_torrentool'] = pieces == reference_pieces
+                    results.append(result)
+
+            self.stdout.write(json.dumps({
+                'size': total_size,
+                'files': len(files),
+                'cpu_count': os.cpu_count(),
+                'results': results,
+            }, indent=2))
+        finally:
+            if not options['keep']:
+                utils.check_and_delete_dir(batch_path)
+
+    def get_result(self, hasher, workers, piece_length, total_size, started_at):
+        wall = time.time() - started_at
+        return {
+            'hasher': hasher,
+            'workers': workers,
+            'piece_length': piece_length,
+            'wall': round(wall, 2),
+            'throughput': round(total_size / wall / 1024 ** 2, 2) if wall else None,
+        }
+
+    def generate_batch(self, size, file_count):
+        batch_path = utils.create_and_get_path(os.path.join(
+            settings.BASE_DIR, 'benchmark', f'batch-{size}-{file_count}'
+        ))
+        file_size = int(size * 1024 ** 3 / file_count)
+
+        # Random blocks repeated with a per file prefix, incompressible
+        # enough and much faster to write than urandom for every byte.
+        block = os.urandom(4 * 1024 ** 2)
+        for index in range(file_count):
+            file_path = os.path.join(batch_path, 'Episode {} [1080p].mkv'.format(str(index + 1).zfill(2)))
+            if os.path.exists(file_path) and os.path.getsize(file_path) == file_size:
+                continue
+
+            with open(file_path, 'wb') as f:
+                written = 0
+                while written < file_size:
+                    chunk = (index.to_bytes(4, 'big') + block)[:file_size - written]
+                    f.write(chunk)
+                    written += len(chunk)
+
+        return batch_path
@@ -1,5 +1,6 @@
 import os
 import uuid
+from datetime import timedelta
 import auto_prefetch
 from django.db import models
 from django.core.exceptions import ValidationError
@@ -88,6 +89,46 @@ class Feed(BaseModel):
         self.last_check_date = timezone.now()
         self.save()
 
+
+class PendingDownload(BaseModel):
+    feed = auto_prefetch.ForeignKey(
+        Feed, on_delete=models.CASCADE, related_name='pending_downloads')
+    qbittorrent = auto_prefetch.ForeignKey(
+        'QBitTorrent', on_delete=models.CASCADE, related_name='pending_downloads')
+    torrent_hash = models.CharField(max_length=100, db_index=True)
+    entry = models.JSONField(default=dict, editable=False)
+
+    def path(self, filename):
+        return os.path.join('pd', str(self.uuid), filename)
+
+    original_torrent_file = models.FileField(upload_to=path, blank=True, null=True)
+    upload_torrent = models.BooleanField(
+        default=False, help_text='Upload to torrent sites once downloaded')
+
+    DOWNLOAD_STATUSES = (
+        ('dl', 'Downloading'),
+        ('proc', 'Processing'),
+        ('fin', 'Finished'),
+        ('err', 'Error'),
+    )
+    status = models.CharField(
+        max_length=50, default='dl', choices=DOWNLOAD_STATUSES, db_index=True)
+    error_message = models.TextField(blank=True, null=True)
+    api_calls = models.JSONField(default=dict, editable=False)
+
+    class Meta:
+        ordering = ['-added_at']
+
+    def __str__(self):
+        return self.entry.get('title', self.torrent_hash)
+
+    def add_api_calls(self, api_calls):
+        for name, count in api_calls.items():
+            self.api_calls[name] = self.api_calls.get(name, 0) + count
+
+    def get_api_call_count(self):
+        return sum(self.api_calls.values())
+
 # class BatchFeed(BaseModel):
 #     site = models.CharField(max_length=100, choices=SITE_CHOICES.choices, db_index=True)
 #     anime = auto_prefetch.ForeignKey('Anime', on_delete=models.CASCADE, related_name='feeds')
@@ -377,6 +418,9 @@ class Episode(BaseModel):
         default=1080, choices=RESOLUTION_CHOICES, db_index=True)
     old_file_name = models.TextField()
     file_name = models.TextField()
+    qbittorrent = auto_prefetch.ForeignKey(
+        'QBitTorrent', on_delete=models.SET_NULL, blank=True, null=True, editable=False,
+        related_name='episodes', help_text='Client the source was downloaded with')
 
     def torrent_path(self, filename):
         return os.path.join('ot', str(self.uuid), filename)
@@ -422,6 +466,7 @@ class Episode(BaseModel):
     )
     episode_status = models.CharField(
         max_length=50, default='dlfin', choices=EPISODE_STATUSES, db_index=True)
+    encode_progress = models.JSONField(default=dict, editable=False)
 
     error_message = models.TextField(blank=True, null=True)
 
@@ -437,6 +482,16 @@ class Episode(BaseModel):
             episode_str += ' | {}'.format(self.info.release_group)
         return episode_str
 
+    def get_encode_progress(self):
+        progress = self.encode_progress
+        if not progress:
+            return '-'
+
+        progress_str = '{} fps | {}x'.format(progress.get('fps'), progress.get('speed'))
+        if progress.get('eta') is not None:
+            progress_str += ' | ETA {}'.format(timedelta(seconds=progress['eta']))
+        return progress_str
+
     @property
     def thumbnail(self):
         thumb = self.screenshots.first()
@@ -584,6 +639,11 @@ class EpisodeInfo(BaseModel):
         max_length=10000, blank=True, null=True)
     original_file_size = models.BigIntegerField(default=0)
     new_file_size = models.BigIntegerField(default=0)
+    timings = models.JSONField(default=dict, editable=False)
+    preset = models.CharField(max_length=20, blank=True, null=True, editable=False)
+    crf = models.FloatField(blank=True, null=True, editable=False)
+    encode_speed = models.FloatField(
+        blank=True, null=True, editable=False, help_text='Encoded seconds of video per second')
 
     class Meta:
         ordering = ['-modified_at']
@@ -597,6 +657,10 @@ class EpisodeInfo(BaseModel):
     def get_new_file_size(self):
         return utils.humansize(self.new_file_size)
 
+    def set_timing(self, stage, seconds):
+        self.timings[stage] = round(seconds, 2)
+        self.save()
+
     def __str__(self):
         return self.episode.name
 
@@ -670,21 +734,49 @@ class AdflyCredential(BaseModel):
 
 
 class QBitTorrent(BaseModel):
-    host = models.CharField(default='localhost', max_length=500, unique=True)
-    port = models.IntegerField(default=8080, unique=True)
-    username = models.CharField(max_length=500, unique=True)
-    password = models.CharField(max_length=500, unique=True)
+    host = models.CharField(default='localhost', max_length=500)
+    port = models.IntegerField(default=8080)
+    username = models.CharField(max_length=500)
+    password = models.CharField(max_length=500)
+    download_path = models.CharField(
+        max_length=1000, blank=True, null=True,
+        help_text='Where the downloads of this client are saved and read from, defaults to BASE_DIR/downloads')
+    max_downloads = models.PositiveIntegerField(
+        default=3, help_text='Downloads this client runs at once')
+    min_free_space = models.PositiveIntegerField(
+        default=10, help_text='GiB kept free on the download disk')
+    enabled = models.BooleanField(default=True, db_index=True)
 
     class Meta:
         verbose_name_plural = 'QBitTorrent'
+        constraints = [
+            models.UniqueConstraint(fields=['host', 'port'], name='unique_qbittorrent_address')
+        ]
 
     def __str__(self):
-        return self.username
+        return f'{self.username}@{self.host}:{self.port}'
 
-    def save(self, *args, **kwargs):
-        if not self.pk and QBitTorrent.objects.exists():
-            raise ValidationError('There can only be one QBitTorrent instance')
-        return super(type(self), self).save(*args, **kwargs)
+
+class DiskReservation(BaseModel):
+    RESERVATION_KINDS = (
+        ('enc', 'Encode'),
+        ('batch', 'Batch'),
+    )
+    kind = models.CharField(max_length=50, choices=RESERVATION_KINDS, db_index=True)
+    label = models.TextField(blank=True, null=True)
+    path = models.CharField(max_length=1000)
+    device = models.BigIntegerField(db_index=True)
+    size = models.BigIntegerField(default=0)
+    file_paths = models.JSONField(default=list, editable=False)
+
+    class Meta:
+        ordering = ['-added_at']
+
+    def __str__(self):
+        return '{} | {} | {}'.format(self.get_kind_display(), self.label, self.get_size())
+
+    def get_size(self):
+        return utils.humansize(self.size)
 
 # class Task(BaseModel):
 #     name = models.CharField(max_length=2000)
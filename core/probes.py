@@ -0,0 +1,136 @@
+import os
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from pymediainfo import MediaInfo
+
+
+class MediaProbe:
+
+    def __init__(self, file_path):
+        self.file_path = os.path.abspath(str(file_path))
+        self.data = cache.get(self.cache_key)
+
+        if self.data is None:
+            self.data = self.parse()
+            self.save()
+
+    @staticmethod
+    def get_cache_key(file_path):
+        file_stat = os.stat(file_path)
+        key = '{}:{}:{}:{}'.format(
+            file_path, file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino
+        )
+        return 'probe:{}'.format(hashlib.sha1(key.encode('utf8')).hexdigest())
+
+    @property
+    def cache_key(self):
+        return self.get_cache_key(self.file_path)
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'PROBE_CACHE_TIMEOUT', 60 * 60 * 24 * 30)
+
+    def parse(self):
+        file_info = MediaInfo.parse(filename=self.file_path)
+        return {
+            'tracks': [track.to_data() for track in file_info.tracks],
+        }
+
+    def save(self):
+        cache.set(self.cache_key, self.data, timeout=self.timeout)
+
+    def link(self, file_path):
+        # Copies and moves keep the content but not the stat, so the probe is
+        # stored again under the new path instead of parsing the copy.
+        file_path = os.path.abspath(str(file_path))
+        cache.set(self.get_cache_key(file_path), self.data, timeout=self.timeout)
+        return MediaProbe(file_path)
+
+    def get_tracks(self, track_type):
+        return [t for t in self.tracks if t.get('track_type') == track_type]
+
+    @property
+    def tracks(self):
+        return self.data['tracks']
+
+    @property
+    def general_track(self):
+        general_tracks = self.get_tracks('General')
+        return general_tracks[0] if general_tracks else {}
+
+    @property
+    def video_tracks(self):
+        return self.get_tracks('Video')
+
+    @property
+    def audio_tracks(self):
+        return self.get_tracks('Audio')
+
+    @property
+    def text_tracks(self):
+        return self.get_tracks('Text')
+
+    @property
+    def video_track(self):
+        return self.video_tracks[0] if self.video_tracks else {}
+
+    @property
+    def has_subtitles(self):
+        return bool(self.text_tracks)
+
+    @property
+    def frame_count(self):
+        return int(self.video_track.get('frame_count') or 0)
+
+    @property
+    def duration(self):
+        duration = self.video_track.get('duration') or self.general_track.get('duration') or 0
+        return float(duration) / 1000
+
+    @property
+    def height(self):
+        return int(self.video_track.get('height') or 0)
+
+    @property
+    def bit_depth(self):
+        return int(self.video_track.get('bit_depth') or 0)
+
+    @property
+    def video_bit_rate(self):
+        bit_rate = self.video_track.get('bit_rate') or self.video_track.get('maximum_bit_rate')
+        if str(bit_rate or '').isdigit():
+            return int(bit_rate)
+
+        # Matroska rarely stores a per track bitrate, the overall one is an
+        # upper bound for the video.
+        overall_bit_rate = self.general_track.get('overall_bit_rate')
+        return int(overall_bit_rate) if str(overall_bit_rate or '').isdigit() else 0
+
+    @property
+    def video_codec(self):
+        return self.video_track.get('format')
+
+    @property
+    def audio_codecs(self):
+        return [t.get('format') for t in self.audio_tracks]
+
+    @property
+    def subtitle_codecs(self):
+        return [t.get('format') for t in self.text_tracks]
+
+    def matches(self, source_probe, deinterlace=False):
+        duration_tolerance = getattr(settings, 'PROBE_DURATION_TOLERANCE', 1)
+        frame_tolerance = getattr(settings, 'PROBE_FRAME_TOLERANCE', 2)
+
+        if abs(self.duration - source_probe.duration) > duration_tolerance:
+            return False
+
+        # Deinterlacing resamples to a new frame rate, so only the duration
+        # can be compared against the source.
+        if not deinterlace and abs(self.frame_count - source_probe.frame_count) > frame_tolerance:
+            return False
+
+        return True
@@ -5,20 +5,23 @@ import random
 import traceback
 import requests
 from io import BytesIO
+from contextlib import ExitStack
 from ftplib import FTP, FTP_TLS
 from urllib.parse import quote
+from datetime import timedelta
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
 from django.utils import timezone
 from django.core.files import File
 from django.core.files.base import ContentFile
 
 import feedparser
 from adfly import AdflyApi
-from pymediainfo import MediaInfo
 from torrentool.api import Torrent
 
 from automin.celery import app
-from core import models, feeders, handlers, encoders, proxies, utils
+from core import models, admission, feeders, handlers, encoders, probes, proxies, torrents, utils
 
 task = app.task
 
@@ -77,24 +80,23 @@ def do_seedbox_upload(args=[]):
 @task
 def do_torrent_upload(episode_id, upload_site_id, adfly_api, video_path):
     adfly_api = adfly_api or get_adfly_session()
-    trackers = models.Tracker.objects.all()
     episode_obj = models.Episode.objects.get(id=episode_id)
     upload_site = models.UploadSite.objects.get(id=upload_site_id)
     file_name = episode_obj.file_name
 
-    announce_urls = []
-    announce_urls.extend(upload_site.trackers.get_trackers())
-    for track in trackers.exclude(id=upload_site.trackers.id):
-        announce_urls.extend(track.get_trackers())
+    announce_urls = torrents.get_announce_urls(upload_site)
 
     torrent_obj, created = models.TorrentFile.objects.get_or_create(
         episode=episode_obj, upload_site=upload_site
     )
 
     if not created:
-        new_torrent = Torrent.from_string(torrent_obj.file.read())
+        new_torrent = torrents.load_torrent(torrent_obj.file.read())
+    elif episode_obj.seedbox_torrent_file:
+        new_torrent = torrents.derive_torrent(episode_obj.seedbox_torrent_file.read(), announce_urls)
     else:
         new_torrent = Torrent.create_from(video_path)
+        new_torrent.name = file_name
         new_torrent.announce_urls = announce_urls
 
     torrent_obj.file_name = f'{file_name}.torrent'
@@ -177,7 +179,10 @@ def handle_torrent_upload(adfly_api, episode_id, video_path):
 def generate_episode_screenshots(episode_id, output_file_path):
     episode_obj = models.Episode.objects.get(pk=episode_id)
 
-    screenshot_files = encoders.GenerateScreenshots(output_file_path, episode_obj.subtype).output_files
+    screenshots = encoders.GenerateScreenshots(output_file_path, episode_obj.subtype)
+    screenshot_files = screenshots.output_files
+
+    episode_obj.info.set_timing('screenshots', screenshots.elapsed)
 
     for screenshot_file_name, screenshot_file in screenshot_files:
         screenshot_obj = models.Screenshot()
@@ -186,33 +191,218 @@ def generate_episode_screenshots(episode_id, output_file_path):
         screenshot_obj.picture.save(screenshot_file_name, screenshot_file, save=False)
         screenshot_obj.save()
 
-def encode_video(task_instance, adfly_api, episode_id, file_path, output_file_path, episode_config):
-    file_name = os.path.basename(file_path)
-    output_file_name = os.path.basename(output_file_path)
+class EncodeProgress:
+
+    def __init__(self, episode_ids, duration):
+        self.episode_ids = list(episode_ids)
+        self.duration = duration
+        self.interval = getattr(settings, 'ENCODE_PROGRESS_INTERVAL', 10)
+        self.last_update = 0
+
+    def __call__(self, progress):
+        # ffmpeg reports twice a second, the database only needs a sample
+        # every few seconds; the final block is always written.
+        finished = progress.get('progress') == 'end'
+        if not finished and time.time() - self.last_update < self.interval:
+            return
+        self.last_update = time.time()
+
+        out_time = utils.to_float(progress.get('out_time_us')) / 1000000
+        speed = utils.to_float(progress.get('speed'))
+
+        eta = None
+        if speed > 0 and self.duration:
+            eta = max(0, int((self.duration - out_time) / speed))
+
+        models.Episode.objects.filter(id__in=self.episode_ids).update(encode_progress={
+            'frame': int(utils.to_float(progress.get('frame'))),
+            'fps': round(utils.to_float(progress.get('fps')), 2),
+            'speed': round(speed, 3),
+            'out_time': round(out_time, 2),
+            'bitrate': progress.get('bitrate'),
+            'eta': eta,
+            'updated_at': timezone.now().isoformat(),
+        }, modified_at=timezone.now())
+
+def get_queued_renditions(exclude_episode_ids=()):
+    all_resolutions = [1080, 720, 480]
+
+    # Renditions other workers are encoding or about to. Rows untouched for
+    # longer than the SLA belong to workers that were killed.
+    queued = models.Episode.objects.filter(
+        episode_status__in=['dlfin', 'enc'],
+        modified_at__gte=timezone.now() - timedelta(seconds=getattr(settings, 'ENCODE_SLA', 6 * 60 * 60)),
+    ).exclude(id__in=exclude_episode_ids).count()
+
+    # Entries still downloading, waiting for a worker or not started yet
+    # each need every rendition they are missing. Entries past 'dl' already
+    # have their renditions counted above, or are finished or failed.
+    for feed_obj in models.Feed.objects.filter(enabled=True):
+        started = set(models.PendingDownload.objects.filter(feed=feed_obj).exclude(
+            status='dl').values_list('entry__torrent_url', flat=True))
+
+        for feed_update in feed_obj.data:
+            if feed_update['torrent_url'] and feed_update['torrent_url'] in started:
+                continue
+
+            try:
+                _, episode_name, episode_resolution, release_group = utils.extract_names(
+                    feed_update['title'].strip(), feed_obj.anime.title, feed_obj.anime.get_alt_names())
+            except IndexError:
+                continue
+            if not episode_name or episode_resolution != 1080:
+                continue
+
+            existing = models.Episode.objects.filter(
+                anime=feed_obj.anime,
+                name__icontains=episode_name,
+                bluray=feed_obj.bluray,
+                uncensored=feed_obj.uncensored,
+                info__release_group=release_group,
+            ).values_list('resolution', flat=True)
+            queued += len(set(all_resolutions) - set(existing))
+
+    return queued
+
+def get_encode_preset(duration, episode_ids):
+    if not getattr(settings, 'ENCODE_ADAPTIVE_PRESET', True):
+        return 'slow', 0
 
+    # The measured speeds are of single encodes, the queue is shared by
+    # every encode worker, the job's own renditions are not.
+    workers = getattr(settings, 'ENCODE_WORKERS', 1)
+    backlog = get_queued_renditions(episode_ids) / workers + len(episode_ids)
+
+    preset_speeds = {}
+    recent_infos = models.EpisodeInfo.objects.filter(
+        encode_speed__isnull=False, preset__isnull=False
+    ).order_by('-modified_at').values_list('preset', 'encode_speed')
+    for preset, encode_speed in recent_infos[:getattr(settings, 'ENCODE_SPEED_SAMPLES', 20)]:
+        preset_speeds.setdefault(preset, []).append(encode_speed)
+
+    return encoders.PresetPolicy(backlog * duration, {
+        preset: sum(speeds) / len(speeds) for preset, speeds in preset_speeds.items()
+    }).select()
+
+def encode_video(task_instance, adfly_api, episode_id, file_path, output_file_path, episode_config):
     episode_obj = models.Episode.objects.get(pk=episode_id)
 
     episode_obj.episode_status = 'enc'
     episode_obj.save()
 
-    if episode_config['hardsubs'] is True:
-        encode_file_size = encoders.EncodeVideoMP4(
-            file_path, output_file_path, episode_config
-        ).file_size
-    else:
-        encode_file_size = encoders.EncodeVideoMKV(
-            file_path, output_file_path, episode_config
-        ).file_size
+    episode_config = {
+        **episode_config,
+        'progress_callback': EncodeProgress([episode_id], probes.MediaProbe(file_path).duration),
+    }
+
+    started_at = time.time()
+
+    # The seedbox torrent pieces are hashed while the output is written.
+    with torrents.PieceHasher(output_file_path) as piece_hasher:
+        if encoders.EncodeVideoRemux.accepts(probes.MediaProbe(file_path), episode_config):
+            encoder = encoders.EncodeVideoRemux(
+                file_path, output_file_path, episode_config
+            )
+            episode_obj.info.preset = 'copy'
+            episode_obj.info.save()
+        elif getattr(settings, 'ENCODE_CHUNKED', False):
+            encoder = encoders.EncodeVideoChunked(
+                file_path, output_file_path, episode_config
+            )
+        elif episode_config['hardsubs'] is True:
+            encoder = encoders.EncodeVideoMP4(
+                file_path, output_file_path, episode_config
+            )
+        else:
+            encoder = encoders.EncodeVideoMKV(
+                file_path, output_file_path, episode_config
+            )
+
+    encode_time = time.time() - started_at
+    encode_speed = None
+    if not (encoder.cached or isinstance(encoder, encoders.EncodeVideoRemux)) and encode_time > 0:
+        encode_speed = episode_config['progress_callback'].duration / encode_time
+
+    store_encoded_video(episode_id, output_file_path, encoder.file_size, encode_time, encode_speed)
+
+    return piece_hasher
+
+def encode_video_ladder(task_instance, adfly_api, episode_ids, file_path, output_file_paths, episode_config):
+    for episode_id in episode_ids.values():
+        episode_obj = models.Episode.objects.get(pk=episode_id)
+        episode_obj.episode_status = 'enc'
+        episode_obj.save()
+
+    episode_config = {
+        **episode_config,
+        'progress_callback': EncodeProgress(episode_ids.values(), probes.MediaProbe(file_path).duration),
+    }
+
+    started_at = time.time()
+
+    with ExitStack() as stack:
+        piece_hashers = {
+            res: stack.enter_context(torrents.PieceHasher(output_file_path))
+            for res, output_file_path in output_file_paths.items()
+        }
+        encoder = encoders.EncodeVideoLadder(
+            file_path, output_file_paths, episode_config
+        )
+
+    encode_time = time.time() - started_at
+    encode_speed = None
+    if encoder.cache_keys and encode_time > 0:
+        # One run encodes every rendition that was not cached.
+        encode_speed = episode_config['progress_callback'].duration * len(encoder.cache_keys) / encode_time
+
+    for episode_resolution, episode_id in episode_ids.items():
+        store_encoded_video(
+            episode_id, output_file_paths[episode_resolution], encoder.file_sizes[episode_resolution],
+            encode_time, encode_speed
+        )
+
+    return piece_hashers
+
+def ingest_episode_file(episode_obj, file_path):
+    file_field = episode_obj.file
+    storage = file_field.storage
+    name = storage.get_available_name(
+        file_field.field.generate_filename(episode_obj, os.path.basename(file_path)),
+        max_length=file_field.field.max_length
+    )
+
+    # Screenshots, seedbox torrents and uploads all read the episode from
+    # disk, so episodes need a storage with local paths.
+    try:
+        stored_file_path = storage.path(name)
+    except NotImplementedError:
+        raise Exception('Episode files need a local file storage')
+
+    # A rename on the same filesystem, otherwise a streamed copy, instead of
+    # a second full copy through the storage layer.
+    utils.create_and_get_path(os.path.dirname(stored_file_path))
+    utils.move_or_copy(file_path, stored_file_path)
+    if getattr(storage, 'file_permissions_mode', None) is not None:
+        os.chmod(stored_file_path, storage.file_permissions_mode)
+    file_field.name = name
+
+def store_encoded_video(episode_id, output_file_path, encode_file_size, encode_time, encode_speed=None):
+    episode_obj = models.Episode.objects.get(pk=episode_id)
 
     if not os.path.exists(output_file_path):
         raise Exception('Encoded episode not found at output path')
 
-    episode_obj.file.save(output_file_name, open(output_file_path, 'rb'), save=False)
+    output_file_probe = probes.MediaProbe(output_file_path)
+
+    ingest_episode_file(episode_obj, output_file_path)
     episode_obj.save()
 
+    output_file_probe.link(episode_obj.file.path)
+
     episode_obj.info.new_file_size = encode_file_size
+    episode_obj.info.encode_speed = encode_speed
     episode_obj.episode_status = 'genscr'
-    episode_obj.info.save()
+    episode_obj.info.set_timing('encode', encode_time)
 
     try:
         generate_episode_screenshots(episode_id, episode_obj.file.path)
@@ -220,167 +410,229 @@ def encode_video(task_instance, adfly_api, episode_id, file_path, output_file_pa
         episode_obj.error_message = traceback.format_exc()
         episode_obj.save()
 
-@task(bind=True)
-def handle_feed(self, feed_id):
-
-    before_start()
+def get_missing_resolutions(feed_obj, episode_name, release_group):
+    return [
+        res for res in [1080, 720, 480] if not models.Episode.objects.filter(
+            anime=feed_obj.anime,
+            resolution=res,
+            name__icontains=episode_name,
+            bluray=feed_obj.bluray,
+            uncensored=feed_obj.uncensored,
+            info__release_group=release_group,
+        ).exists()
+    ]
 
-    adfly_api = get_adfly_session()
+def can_stream_entry(feed_obj, feed_update):
+    # Only the ladder reads the source in a single front to back pass, any
+    # other path needs the whole file first.
+    if not getattr(settings, 'ENCODE_LADDER', True) or getattr(settings, 'ENCODE_CHUNKED', False):
+        return False
 
-    feed_obj = models.Feed.objects.get(pk=feed_id)
     anime_obj = feed_obj.anime
-    feed_updates = feed_obj.data
+    _, episode_name, _, release_group = \
+        utils.extract_names(feed_update['title'].strip(), anime_obj.title, anime_obj.get_alt_names())
+    return len(get_missing_resolutions(feed_obj, episode_name, release_group)) > 1
 
-    for feed_iter, feed_update in enumerate(feed_updates):
-        if not guv(feed_obj).enabled:
-            break
-
-        title = feed_update['title'].strip()
-        torrent_magnet = feed_update['torrent_magnet']
-        torrent_url = feed_update['torrent_url']
-
-        original_episode_name, episode_name, episode_resolution, release_group = \
-            utils.extract_names(title, feed_obj.anime.title, feed_obj.anime.get_alt_names())
+def handle_feed_entry(task_instance, adfly_api, feed_obj, feed_update, episode_dl, ot_file=None, upload_torrent=False, stream_reader=None, reservations=None):
+    anime_obj = feed_obj.anime
 
-        if not (original_episode_name and episode_name and episode_resolution and release_group):
-            print('Error extracting names')
-            continue
+    title = feed_update['title'].strip()
+    torrent_magnet = feed_update['torrent_magnet']
+    torrent_url = feed_update['torrent_url']
 
-        if episode_resolution != 1080:
-            continue
-
-        all_resolutions = [1080, 720, 480]
+    original_episode_name, episode_name, episode_resolution, release_group = \
+        utils.extract_names(title, anime_obj.title, anime_obj.get_alt_names())
 
-        existing_episodes = {
-            res: models.Episode.objects.filter(
-                anime=anime_obj,
-                resolution=res,
-                name__icontains=episode_name,
-                bluray=feed_obj.bluray,
-                uncensored=feed_obj.uncensored,
-                info__release_group=release_group,
-            ).exists() for res in all_resolutions
-        }
+    all_resolutions = [1080, 720, 480]
 
-        if all(existing_episodes.values()):
-            continue
+    ot_torrent = None
+    if ot_file:
+        ot_torrent = Torrent.from_string(ot_file)
+        ot_name = f'{ot_torrent.name}.torrent'
+    else:
+        ot_name = episode_dl['file_name']
+        ot_name = f'{ot_name}.torrent'
 
-        ot_torrent, ot_name = None, ''
-        if torrent_url:
-            ot_file = requests.get(
-                torrent_url,
-                headers=utils.get_header(),
-                **(proxies.proxies if feed_obj.site == 'NyaaSi' else {})
-            ).content
-            ot_torrent = Torrent.from_string(ot_file)
-            ot_name = f'{ot_torrent.name}.torrent'
+    episode_dl_info = probes.MediaProbe(episode_dl['file_path'])
 
-            episode_dl = handlers.DownloadEpisode(
-                torrent_file=ot_file
-            ).download()
-        else:
-            episode_dl = handlers.DownloadEpisode(
-                magnet_url=torrent_magnet
-            ).download_from_magnet()
+    episode_subtype = 'softsubs' if episode_dl_info.has_subtitles else 'hardsubs'
+    new_episodes = {}
 
-            ot_name = episode_dl['file_name']
-            ot_name = f'{ot_name}.torrent'
+    missing_resolutions = get_missing_resolutions(feed_obj, episode_name, release_group)
 
-        episode_dl_file_name, episode_dl_file_path, episode_dl_file_size = \
-            episode_dl['file_name'], episode_dl['file_path'], episode_dl['file_size']
+    # complete_download only streams the entries can_stream_entry allows,
+    # another worker may have added renditions since.
+    if stream_reader and not can_stream_entry(feed_obj, feed_update):
+        raise Exception('A streamed source needs a ladder encode of several renditions')
 
-        episode_dl_info = MediaInfo.parse(filename=episode_dl_file_path)
+    for episode_resolution in all_resolutions:
 
-        for episode_resolution in all_resolutions:
+        if episode_resolution not in missing_resolutions:
+            continue
 
-            if models.Episode.objects.filter(
-                    anime=anime_obj,
-                    resolution=episode_resolution,
-                    name__icontains=episode_name,
-                    bluray=feed_obj.bluray,
-                    uncensored=feed_obj.uncensored,
-                    info__release_group=release_group,
-                ).exists():
-                continue
+        new_episode_title, created = models.EpisodeTitle.objects.get_or_create(
+            anime=anime_obj, title=episode_name
+        )
 
-            new_episode_title, created = models.EpisodeTitle.objects.get_or_create(
-                anime=anime_obj, title=episode_name
-            )
+        new_episode = models.Episode()
+
+        new_episode.name = episode_name
+        new_episode.title = new_episode_title
+        new_episode.resolution = episode_resolution
+        new_episode.anime = anime_obj
+        new_episode.subtype = episode_subtype
+        new_episode.bluray = feed_obj.bluray
+        new_episode.uncensored = feed_obj.uncensored
+
+        new_episode.old_file_name = original_episode_name
+        new_episode.qbittorrent = episode_dl.get('qbittorrent')
+
+        if ot_torrent:
+            new_episode.original_torrent_file.save(ot_name, ContentFile(ot_torrent.to_string()), save=False)
+
+        new_name = utils.GenerateFileName(
+            episode_name, episode_resolution,
+            extra_tags={'bluray': feed_obj.bluray, 'uncensored': feed_obj.uncensored, 'others': guv(feed_obj).extra_tags},
+            file_ext='mkv' if episode_dl_info.has_subtitles else 'mp4',
+        ).episode
+        new_episode.file_name = new_name
+        new_episode.save()
+
+        new_episode_info = models.EpisodeInfo()
+        new_episode_info.episode = new_episode
+        new_episode_info.original_torrent_url = torrent_url
+        new_episode_info.original_magnet_url = torrent_magnet
+        new_episode_info.original_file_size = int(episode_dl['file_size'])
+        new_episode_info.release_group = release_group
+        new_episode_info.save()
+
+        new_episode.watch_url = f'{settings.SITE_URL}/watch/{new_episode.uuid}'
+        new_episode.download_url = f'{settings.SITE_URL}/download/{new_episode.uuid}'
+        new_episode.torrent_url = '{}/download/torrent/{}/{}.torrent'.format(settings.SITE_URL, new_episode.uuid, quote(new_episode.file_name))
+        new_episode.magnet_url = f'{settings.SITE_URL}/download/magnet/{new_episode.uuid}'
+        new_episode.episode_status = 'dlfin'
+        new_episode.save()
+
+        output_file_path = os.path.join(utils.create_and_get_path(
+            os.path.join(settings.BASE_DIR, 'episodes')
+        ), new_name)
+
+        new_episodes[episode_resolution] = (new_episode, output_file_path)
+
+    admission.track(reservations, [output_file_path for _, output_file_path in new_episodes.values()])
+
+    episode_config = {
+        **anime_obj.get_settings(),
+        'hardsubs': episode_subtype == 'hardsubs',
+        'deinterlace': feed_obj.deinterlace,
+        'source_hash': ot_torrent.info_hash if ot_torrent else utils.get_magnet_hash(torrent_magnet),
+    }
 
-            new_episode = models.Episode()
+    # A source encoded before keeps the preset and CRF it got then, so the
+    # renditions redone from it still hit the encode cache.
+    previous_info = models.EpisodeInfo.objects.filter(
+        Q(original_torrent_url=torrent_url) if torrent_url else Q(original_magnet_url=torrent_magnet),
+        preset__isnull=False, crf__isnull=False,
+    ).exclude(preset='copy').exclude(
+        episode__in=[new_episode for new_episode, _ in new_episodes.values()]
+    ).first()
+
+    if previous_info:
+        encode_preset = previous_info.preset
+        episode_config['crf'] = int(previous_info.crf)
+    else:
+        # Trade quality for throughput only while the backlog would miss the SLA.
+        encode_preset, crf_offset = get_encode_preset(
+            episode_dl_info.duration, [new_episode.id for new_episode, _ in new_episodes.values()]
+        )
+        # get_settings truncates the CRF, so the recorded value is the one used.
+        episode_config['crf'] = int(episode_config['crf']) + crf_offset
+    episode_config['preset'] = encode_preset
 
-            new_episode.name = episode_name
-            new_episode.title = new_episode_title
-            new_episode.resolution = episode_resolution
-            new_episode.anime = anime_obj
-            if episode_dl_info.text_tracks:
-                new_episode.subtype = 'softsubs'
-            else:
-                new_episode.subtype = 'hardsubs'
-            new_episode.bluray = feed_obj.bluray
-            new_episode.uncensored = feed_obj.uncensored
+    for new_episode, _ in new_episodes.values():
+        new_episode.info.preset = encode_preset
+        new_episode.info.crf = episode_config['crf']
+        new_episode.info.save()
 
-            new_episode.old_file_name = original_episode_name
+    encode_ladder = getattr(settings, 'ENCODE_LADDER', True) and not getattr(settings, 'ENCODE_CHUNKED', False)
 
-            if ot_torrent:
-                new_episode.original_torrent_file.save(ot_name, ContentFile(ot_torrent.to_string()), save=False)
+    encode_audio = None
+    if getattr(settings, 'ENCODE_SHARED_AUDIO', True) and new_episodes and not stream_reader:
+        encode_audio = encoders.EncodeAudio(episode_dl['file_path'], [
+            encoders.BaseEncoder().resolution_settings(res, anime_obj.crf)[0] for res in new_episodes
+        ])
+        episode_config['audio_file_paths'] = encode_audio.output_file_paths
 
-            new_name = utils.GenerateFileName(
-                episode_name, episode_resolution,
-                extra_tags={'bluray': feed_obj.bluray, 'uncensored': feed_obj.uncensored, 'others': guv(feed_obj).extra_tags},
-                file_ext='mkv' if episode_dl_info.text_tracks else 'mp4',
-            ).episode
-            new_episode.file_name = new_name
-            new_episode.save()
+        for new_episode, _ in new_episodes.values():
+            new_episode.info.set_timing('audio', encode_audio.elapsed)
 
-            new_episode_info = models.EpisodeInfo()
-            new_episode_info.episode = new_episode
-            new_episode_info.original_torrent_url = torrent_url
-            new_episode_info.original_magnet_url = torrent_magnet
-            new_episode_info.original_file_size = int(episode_dl['file_size'])
-            new_episode_info.release_group = release_group
-            new_episode_info.save()
-
-            watch_url = f'{settings.SITE_URL}/watch/{new_episode.uuid}'
-            download_url = f'{settings.SITE_URL}/download/{new_episode.uuid}'
-            torrent_url = '{}/download/torrent/{}/{}.torrent'.format(settings.SITE_URL, new_episode.uuid, quote(new_episode.file_name))
-            magnet_url = f'{settings.SITE_URL}/download/magnet/{new_episode.uuid}'
-
-            new_episode.watch_url = watch_url
-            new_episode.download_url = download_url
-            new_episode.torrent_url = torrent_url
-            new_episode.magnet_url = magnet_url
-            new_episode.episode_status = 'dlfin'
-            new_episode.save()
+    # The shared audio is removed whether or not the encodes succeed.
+    try:
+        # Renditions the source already fits are remuxed on their own. The
+        # bitrates of a partial file are not reliable, so a streamed source
+        # goes through the ladder whole.
+        ladder_episodes = {
+            res: episode for res, episode in new_episodes.items()
+            if stream_reader or not encoders.EncodeVideoRemux.accepts(episode_dl_info, {**episode_config, 'resolution': res})
+        }
 
-            output_file_path = os.path.join(utils.create_and_get_path(
-                os.path.join(settings.BASE_DIR, 'episodes')
-            ), new_name)
+        # One decode feeds every missing rendition, instead of one full
+        # decode and filter pass per resolution. Chunked encoding already
+        # spreads a single rendition over every core, so it takes priority.
+        encode_ladder = encode_ladder and len(ladder_episodes) > 1
 
+        piece_hashers = {}
+        if encode_ladder:
             try:
-                encode_video(
-                    self,
+                piece_hashers = encode_video_ladder(
+                    task_instance,
                     adfly_api,
-                    new_episode.id,
+                    {res: new_episode.id for res, (new_episode, _) in ladder_episodes.items()},
                     episode_dl['file_path'],
-                    output_file_path,
-                    {
-                        **anime_obj.get_settings(),
-                        'resolution': episode_resolution,
-                        'hardsubs': new_episode.subtype == 'hardsubs',
-                        'deinterlace': feed_obj.deinterlace,
-                    }
+                    {res: output_file_path for res, (_, output_file_path) in ladder_episodes.items()},
+                    {**episode_config, 'input_reader': stream_reader}
                 )
 
-                new_episode = models.Episode.objects.get(id=new_episode.id)
+                if stream_reader:
+                    stream_reader.wait_complete()
+            except Exception as e:
+                for new_episode, _ in ladder_episodes.values():
+                    new_episode = guv(new_episode)
+                    new_episode.episode_status = 'err'
+                    new_episode.error_message = traceback.format_exc()
+                    new_episode.save()
+                raise e
+
+        for episode_resolution, (new_episode, output_file_path) in new_episodes.items():
+            new_name = new_episode.file_name
+            watch_url, download_url, torrent_url, magnet_url = \
+                new_episode.watch_url, new_episode.download_url, new_episode.torrent_url, new_episode.magnet_url
 
-                seedbox_torrent_file = Torrent.create_from(output_file_path)
+            try:
+                if not (encode_ladder and episode_resolution in ladder_episodes):
+                    piece_hashers[episode_resolution] = encode_video(
+                        task_instance,
+                        adfly_api,
+                        new_episode.id,
+                        episode_dl['file_path'],
+                        output_file_path,
+                        {
+                            **episode_config,
+                            'resolution': episode_resolution,
+                        }
+                    )
 
-                all_announce_urls = []
-                trackers = models.Tracker.objects.all()
-                for track in trackers:
-                    all_announce_urls.extend(track.get_trackers())
-                seedbox_torrent_file.announce_urls = all_announce_urls
+                new_episode = models.Episode.objects.get(id=new_episode.id)
+                episode_file_path = new_episode.file.path
+                admission.track(reservations, [episode_file_path])
+
+                # Unless it was hashed during the encode, this is the only full
+                # read and hash of the file, every upload site torrent is
+                # derived from this one.
+                seedbox_torrent_file = torrents.create_torrent(
+                    episode_file_path, piece_hashers.get(episode_resolution), name=new_name
+                )
+                seedbox_torrent_file.announce_urls = torrents.get_announce_urls()
 
                 new_episode.seedbox_torrent_file.save(f'{new_name}.torrent', ContentFile(seedbox_torrent_file.to_string()), save=False)
                 new_episode.save()
@@ -389,17 +641,13 @@ def handle_feed(self, feed_id):
                 new_episode.info.save()
 
                 if guv(feed_obj).upload_seedbox:
-                    utils.retry(handle_seedbox_upload, [new_episode.id, output_file_path])
+                    utils.retry(handle_seedbox_upload, [new_episode.id, episode_file_path])
 
                 new_episode.episode_status = 'upt'
                 new_episode.info.save()
 
-                if guv(feed_obj).upload_torrent:
-                    handle_torrent_upload(adfly_api, new_episode.id, output_file_path)
-                else:
-                    updated_feed_obj = guv(feed_obj)
-                    if updated_feed_obj.upload_last_episode_torrent and (len(feed_updates)-1) == feed_iter:
-                        handle_torrent_upload(adfly_api, new_episode.id, output_file_path)
+                if upload_torrent:
+                    handle_torrent_upload(adfly_api, new_episode.id, episode_file_path)
 
             except Exception as e:
                 new_episode.episode_status = 'err'
@@ -435,15 +683,287 @@ def handle_feed(self, feed_id):
             new_episode.save()
 
             utils.check_and_delete(output_file_path)
+    finally:
+        if encode_audio:
+            utils.check_and_delete_dir(encode_audio.output_dir_path)
 
+    # A streamed source is deleted by complete_download, once its torrent is
+    # out of qBittorrent.
+    if not stream_reader:
         utils.check_and_delete(episode_dl['file_path'])
 
+
+@task(bind=True)
+def handle_feed(self, feed_id):
+
+    before_start()
+
+    feed_obj = models.Feed.objects.get(pk=feed_id)
+    anime_obj = feed_obj.anime
+    feed_updates = feed_obj.data
+
+    # Only starts the downloads. complete_download picks each entry up again
+    # once qBittorrent reports it finished, so no worker waits on a download.
+    # Downloads run ahead of the encodes only as far as the QBitTorrent slots
+    # and disks allow, the rest of the feed is started as they complete.
+    deferred = False
+
+    for feed_iter, feed_update in enumerate(feed_updates):
+        if not guv(feed_obj).enabled:
+            break
+
+        title = feed_update['title'].strip()
+        torrent_magnet = feed_update['torrent_magnet']
+        torrent_url = feed_update['torrent_url']
+
+        original_episode_name, episode_name, episode_resolution, release_group = \
+            utils.extract_names(title, feed_obj.anime.title, feed_obj.anime.get_alt_names())
+
+        if not (original_episode_name and episode_name and episode_resolution and release_group):
+            print('Error extracting names')
+            continue
+
+        if episode_resolution != 1080:
+            continue
+
+        all_resolutions = [1080, 720, 480]
+
+        existing_episodes = {
+            res: models.Episode.objects.filter(
+                anime=anime_obj,
+                resolution=res,
+                name__icontains=episode_name,
+                bluray=feed_obj.bluray,
+                uncensored=feed_obj.uncensored,
+                info__release_group=release_group,
+            ).exists() for res in all_resolutions
+        }
+
+        if all(existing_episodes.values()):
+            continue
+
+        # Failed downloads are not retried on their own, deleting the
+        # pending download lets the next run start it again. This runs after
+        # every completion, so known entries are skipped before any request.
+        pending_downloads = models.PendingDownload.objects.filter(status__in=['dl', 'proc', 'err'])
+        if torrent_url:
+            pending_downloads = pending_downloads.filter(entry__torrent_url=torrent_url)
+        else:
+            pending_downloads = pending_downloads.filter(torrent_hash=utils.get_magnet_hash(torrent_magnet))
+        if pending_downloads.exists():
+            continue
+
+        if not handlers.pick_qbittorrent():
+            deferred = True
+            break
+
+        ot_file = None
+        if torrent_url:
+            ot_file = requests.get(
+                torrent_url,
+                headers=utils.get_header(),
+                **(proxies.proxies if feed_obj.site == 'NyaaSi' else {})
+            ).content
+            torrent_hash = Torrent.from_string(ot_file).info_hash
+        else:
+            torrent_hash = utils.get_magnet_hash(torrent_magnet)
+
+        # Placed on the least loaded QBitTorrent with room for the file.
+        try:
+            if ot_file:
+                downloader = handlers.DownloadEpisode(torrent_file=ot_file)
+            else:
+                downloader = handlers.DownloadEpisode(magnet_url=torrent_magnet)
+        except handlers.NoBackendAvailable:
+            deferred = True
+            break
+
+        # Every completion runs this again, so several workers can take the
+        # same feed at once. The entry is claimed under a short lock on the
+        # feed and committed before the torrent is added, so no other run
+        # adds it too and no torrent is left in qBittorrent untracked.
+        with transaction.atomic():
+            locked_feed_obj = models.Feed.objects.select_for_update().get(pk=feed_obj.pk)
+
+            # The same torrent can be listed under another url.
+            if models.PendingDownload.objects.filter(
+                    torrent_hash=torrent_hash, status__in=['dl', 'proc', 'err']).exists():
+                continue
+
+            pending_obj = models.PendingDownload()
+            pending_obj.feed = feed_obj
+            pending_obj.qbittorrent = downloader.qbt_obj
+            pending_obj.torrent_hash = downloader.torrent_hash
+            pending_obj.entry = feed_update
+            pending_obj.upload_torrent = locked_feed_obj.upload_torrent or \
+                (locked_feed_obj.upload_last_episode_torrent and (len(feed_updates)-1) == feed_iter)
+            if ot_file:
+                pending_obj.original_torrent_file.save(
+                    f'{downloader.torrent_file.name}.torrent', ContentFile(ot_file), save=False)
+            pending_obj.save()
+
+        try:
+            if ot_file:
+                downloader.start()
+            else:
+                downloader.start_from_magnet()
+        except Exception as e:
+            pending_obj.status = 'err'
+            pending_obj.error_message = traceback.format_exc()
+            pending_obj.add_api_calls(downloader.api_calls)
+            pending_obj.save()
+            raise e
+
+        # Only the counters, the download may already be past 'dl'.
+        pending_obj.add_api_calls(downloader.api_calls)
+        models.PendingDownload.objects.filter(pk=pending_obj.pk).update(api_calls=pending_obj.api_calls)
+
+    if deferred:
+        # Completions of this feed's downloads start the rest, without any
+        # in flight it has to retry on its own.
+        if not models.PendingDownload.objects.filter(feed=feed_obj, status='dl').exists():
+            handle_feed.apply_async((feed_obj.id,), countdown=getattr(settings, 'DOWNLOAD_RETRY_DELAY', 60 * 10))
+        return
+
     feed_obj = guv(feed_obj)
     if feed_obj.upload_last_episode_torrent:
         feed_obj.upload_last_episode_torrent = False
         feed_obj.upload_torrent = True
         feed_obj.save()
 
+@task(bind=True)
+def complete_download(self, pending_id):
+    # The on-complete callback and the sweeper can both report a download,
+    # only the one that flips it out of 'dl' goes on.
+    if not models.PendingDownload.objects.filter(pk=pending_id, status='dl').update(status='proc'):
+        return
+
+    pending_obj = models.PendingDownload.objects.get(pk=pending_id)
+    downloader = None
+
+    try:
+        downloader = handlers.DownloadEpisode(
+            torrent_hash=pending_obj.torrent_hash, qbt_obj=pending_obj.qbittorrent
+        )
+
+        # In stream ingest mode the encode starts while the file arrives.
+        stream_reader = None
+        if not downloader.is_complete():
+            # Entries the ladder cannot take wait for the whole file, without
+            # tying up a worker until then.
+            if getattr(settings, 'DOWNLOAD_STREAM_INGEST', False) and \
+                    can_stream_entry(pending_obj.feed, pending_obj.entry):
+                stream_reader = downloader.get_stream_reader()
+
+            if not stream_reader:
+                pending_obj.status = 'dl'
+                pending_obj.add_api_calls(downloader.api_calls)
+                pending_obj.save()
+                return
+
+        before_start()
+
+        adfly_api = get_adfly_session()
+
+        ot_file = None
+        if pending_obj.original_torrent_file:
+            ot_file = pending_obj.original_torrent_file.open('rb').read()
+
+        episode_dl = downloader.get_file_info()
+
+        # Held until the encodes fit on disk, the sweeper hands the download
+        # back here on its next run.
+        try:
+            reservations = admission.reserve(
+                'enc', admission.get_encode_footprint(episode_dl['file_size'], [1080, 720, 480]), str(pending_obj)
+            )
+        except admission.NoDiskSpace:
+            traceback.print_exc()
+            if stream_reader:
+                stream_reader.close()
+            pending_obj.status = 'dl'
+            pending_obj.add_api_calls(downloader.api_calls)
+            pending_obj.save()
+            return
+
+        try:
+            if not stream_reader:
+                # Removed from qBittorrent once the encode has read all of it.
+                downloader.finish()
+
+            # Its slot is free, so the next entries download during the encode.
+            handle_feed.delay(pending_obj.feed_id)
+
+            handle_feed_entry(
+                self,
+                adfly_api,
+                pending_obj.feed,
+                pending_obj.entry,
+                episode_dl,
+                ot_file,
+                pending_obj.upload_torrent,
+                stream_reader,
+                reservations
+            )
+        finally:
+            admission.release(reservations)
+            if stream_reader:
+                # Removed before its file is deleted, and when the encode
+                # failed too, so no slot is held by a download nothing reads.
+                stream_reader.close()
+                downloader.finish()
+
+        if stream_reader:
+            utils.check_and_delete(episode_dl['file_path'])
+    except Exception as e:
+        pending_obj.status = 'err'
+        pending_obj.error_message = traceback.format_exc()
+        if downloader:
+            pending_obj.add_api_calls(downloader.api_calls)
+        pending_obj.save()
+        raise e
+
+    pending_obj.status = 'fin'
+    pending_obj.add_api_calls(downloader.api_calls)
+    pending_obj.save()
+
+@task
+def check_pending_downloads():
+    pending_objs = list(models.PendingDownload.objects.filter(status='dl'))
+    if not pending_objs:
+        return
+
+    timeout = getattr(settings, 'DOWNLOAD_TIMEOUT', 60 * 60 * 24)
+    stream_ingest = getattr(settings, 'DOWNLOAD_STREAM_INGEST', False)
+
+    # A single incremental sync per QBitTorrent covers every download in flight.
+    qbt_states = {}
+    for pending_obj in pending_objs:
+        if pending_obj.qbittorrent_id not in qbt_states:
+            qbt_client = handlers.get_qbt_client(pending_obj.qbittorrent)
+            torrent_state = handlers.get_torrent_state_cache(pending_obj.qbittorrent)
+            torrent_state.sync(qbt_client, force=True)
+            qbt_states[pending_obj.qbittorrent_id] = (qbt_client, torrent_state)
+
+        qbt_client, torrent_state = qbt_states[pending_obj.qbittorrent_id]
+        qtorrent = torrent_state.get(qbt_client, pending_obj.torrent_hash)
+
+        if qtorrent and handlers.is_torrent_complete(qtorrent):
+            complete_download.delay(pending_obj.id)
+        elif qtorrent and stream_ingest and handlers.is_stream_ready(qtorrent):
+            complete_download.delay(pending_obj.id)
+        elif not qtorrent and (timezone.now() - pending_obj.added_at).total_seconds() > 60:
+            # Rows are claimed just before their torrent is added.
+            pending_obj.status = 'err'
+            pending_obj.error_message = 'Torrent is no longer in qBittorrent'
+            pending_obj.save()
+            handle_feed.delay(pending_obj.feed_id)
+        elif (timezone.now() - pending_obj.added_at).total_seconds() > timeout:
+            pending_obj.status = 'err'
+            pending_obj.error_message = 'Download timed out'
+            pending_obj.save()
+            handle_feed.delay(pending_obj.feed_id)
+
 @task
 def check_feed_updates():
     for feed in models.Feed.objects.filter(enabled=True):
@@ -482,20 +1002,14 @@ def handle_batch_upload(adfly_api, batch_id, batch_path, screenshots):
     if 'result[]=Success' not in seedbox_response.headers['Location']:
         raise Exception('Error uploading batch torrent file')
 
-    trackers = models.Tracker.objects.all()
+    seedbox_torrent_bytes = seedbox_torrent_file.open('rb').read()
 
     for upload_site in models.UploadSite.objects.filter(enabled=True):
         if models.TorrentFile.objects.filter(batch=batch_obj, upload_site=upload_site).exists():
             continue
 
-        new_torrent = Torrent.create_from(batch_path)
-        new_torrent.name = batch_obj.file_name
-
-        announce_urls = []
-        announce_urls.extend(upload_site.trackers.get_trackers())
-        for track in trackers.exclude(id=upload_site.trackers.id):
-            announce_urls.extend(track.get_trackers())
-        new_torrent.announce_urls = announce_urls
+        announce_urls = torrents.get_announce_urls(upload_site)
+        new_torrent = torrents.derive_torrent(seedbox_torrent_bytes, announce_urls)
 
         torrent_obj = models.TorrentFile()
         torrent_obj.batch = batch_obj
@@ -549,6 +1063,19 @@ def handle_batch_upload(adfly_api, batch_id, batch_path, screenshots):
         torrent_link_obj.short_magnet_url = short_urls[1]['short_url']
         torrent_link_obj.save()
 
+def build_batch_workspace(batch_obj, batch_path):
+    # The episodes are linked into the batch directory, or cloned or
+    # streamed when that is not possible, never read into memory.
+    for episode in batch_obj.episodes.all():
+        be_file_path = os.path.join(batch_path, episode.file_name)
+        utils.check_and_delete(be_file_path)
+        utils.link_or_copy(episode.file.path, be_file_path)
+
+def create_batch_torrent(batch_obj, batch_path):
+    if getattr(settings, 'BATCH_TORRENT_PADDED', False) or getattr(settings, 'TORRENT_HYBRID', False):
+        return torrents.create_padded_batch_torrent(batch_path, batch_obj.episodes.all())
+    return torrents.create_batch_torrent(batch_path)
+
 def set_batch_screenshots(batch_id):
     batch_obj = models.Batch.objects.get(pk=batch_id)
 
@@ -586,26 +1113,31 @@ def missing_batch_uploads(batch_id):
         )
     )
 
-    for episode in batch_obj.episodes.all():
-        be_file_path = os.path.join(batch_path, episode.file_name)
-        be_file = open(be_file_path, 'wb')
-        be_file.write(episode.file.read())
+    try:
+        reservations = admission.reserve('batch', admission.get_batch_footprint(batch_obj), str(batch_obj))
+    except admission.NoDiskSpace:
+        # Held until the workspace fits on disk.
+        traceback.print_exc()
+        missing_batch_uploads.apply_async((batch_id,), countdown=getattr(settings, 'DISK_RETRY_DELAY', 60 * 10))
+        return
 
-    seedbox_torrent_file = Torrent.create_from(batch_path)
-    seedbox_torrent_file.name = batch_obj.file_name
+    # The workspace and its reservation go whether or not the uploads succeed.
+    try:
+        admission.track(reservations, [batch_path])
+        build_batch_workspace(batch_obj, batch_path)
 
-    all_announce_urls = []
-    trackers = models.Tracker.objects.all()
-    for track in trackers:
-        all_announce_urls.extend(track.get_trackers())
-    seedbox_torrent_file.announce_urls = all_announce_urls
+        seedbox_torrent_file = create_batch_torrent(batch_obj, batch_path)
+        seedbox_torrent_file.name = batch_obj.file_name
 
-    batch_obj.seedbox_torrent_file.save(f'{batch_obj.file_name}.torrent', ContentFile(seedbox_torrent_file.to_string()), save=False)
-    batch_obj.save()
+        seedbox_torrent_file.announce_urls = torrents.get_announce_urls()
 
-    handle_batch_upload(adfly_api, batch_id, batch_path, batch_obj.screenshots or set_batch_screenshots(batch_id))
+        batch_obj.seedbox_torrent_file.save(f'{batch_obj.file_name}.torrent', ContentFile(seedbox_torrent_file.to_string()), save=False)
+        batch_obj.save()
 
-    utils.check_and_delete_dir(batch_path)
+        handle_batch_upload(adfly_api, batch_id, batch_path, batch_obj.screenshots or set_batch_screenshots(batch_id))
+    finally:
+        utils.check_and_delete_dir(batch_path)
+        admission.release(reservations)
 
 @task
 def handle_batch(batch_id):
@@ -622,79 +1154,84 @@ def handle_batch(batch_id):
         )
     )
 
-    subtypes = []
-    for episode in batch_obj.episodes.all():
-        subtypes.append(episode.subtype)
-        be_file_path = os.path.join(batch_path, episode.file_name)
-        be_file = open(be_file_path, 'wb')
-        be_file.write(episode.file.read())
+    subtypes = [episode.subtype for episode in batch_obj.episodes.all()]
 
-    subtypes = utils.remove_duplicates(subtypes)
-    batch_obj.subtypes = subtypes[0]
+    try:
+        reservations = admission.reserve('batch', admission.get_batch_footprint(batch_obj), str(batch_obj))
+    except admission.NoDiskSpace:
+        # Held until the workspace fits on disk.
+        traceback.print_exc()
+        handle_batch.apply_async((batch_id,), countdown=getattr(settings, 'DISK_RETRY_DELAY', 60 * 10))
+        return
 
-    batch_obj.batch_status = 2
-    batch_obj.save()
+    # The workspace and its reservation go whether or not the batch succeeds.
+    try:
+        admission.track(reservations, [batch_path])
+        build_batch_workspace(batch_obj, batch_path)
 
-    file_name = utils.GenerateFileName(
-        batch_obj.name, batch_obj.resolution,
-        extra_tags={'bluray': batch_obj.bluray, 'uncensored': batch_obj.uncensored}
-    ).batch
-    release_group = ', '.join(list(batch_obj.episodes.order_by().values_list('info__release_group', flat=True).distinct()))
+        subtypes = utils.remove_duplicates(subtypes)
+        batch_obj.subtypes = subtypes[0]
 
-    seedbox_torrent_file = Torrent.create_from(batch_path)
-    seedbox_torrent_file.name = file_name
+        batch_obj.batch_status = 2
+        batch_obj.save()
 
-    batch_obj.file_name = file_name
-    batch_obj.release_group = release_group
-    batch_obj.total_size = seedbox_torrent_file.total_size
+        file_name = utils.GenerateFileName(
+            batch_obj.name, batch_obj.resolution,
+            extra_tags={'bluray': batch_obj.bluray, 'uncensored': batch_obj.uncensored}
+        ).batch
+        release_group = ', '.join(list(batch_obj.episodes.order_by().values_list('info__release_group', flat=True).distinct()))
 
-    torrent_url = '{}/download/batch/torrent/{}/{}.torrent'.format(settings.SITE_URL, batch_obj.uuid, quote(batch_obj.file_name))
-    magnet_url = f'{settings.SITE_URL}/download/batch/magnet/{batch_obj.uuid}'
+        seedbox_torrent_file = create_batch_torrent(batch_obj, batch_path)
+        seedbox_torrent_file.name = file_name
 
-    batch_obj.torrent_url = torrent_url
-    batch_obj.magnet_url = magnet_url
+        batch_obj.file_name = file_name
+        batch_obj.release_group = release_group
+        batch_obj.total_size = torrents.get_content_size(seedbox_torrent_file)
 
-    short_urls = {
-        'data':[
-            {'short_url': torrent_url},
-            {'short_url': magnet_url}
-        ]
-    }
+        torrent_url = '{}/download/batch/torrent/{}/{}.torrent'.format(settings.SITE_URL, batch_obj.uuid, quote(batch_obj.file_name))
+        magnet_url = f'{settings.SITE_URL}/download/batch/magnet/{batch_obj.uuid}'
 
-    try:
-        short_urls = adfly_api.shorten([
-            torrent_url,
-            magnet_url,
-        ])
-    except:
-        traceback.print_exc()
+        batch_obj.torrent_url = torrent_url
+        batch_obj.magnet_url = magnet_url
 
-    short_urls = short_urls['data']
+        short_urls = {
+            'data':[
+                {'short_url': torrent_url},
+                {'short_url': magnet_url}
+            ]
+        }
 
-    batch_obj.short_torrent_url = short_urls[0]['short_url']
-    batch_obj.short_magnet_url = short_urls[1]['short_url']
+        try:
+            short_urls = adfly_api.shorten([
+                torrent_url,
+                magnet_url,
+            ])
+        except:
+            traceback.print_exc()
 
-    all_announce_urls = []
-    trackers = models.Tracker.objects.all()
-    for track in trackers:
-        all_announce_urls.extend(track.get_trackers())
-    seedbox_torrent_file.announce_urls = all_announce_urls
+        short_urls = short_urls['data']
 
-    batch_obj.seedbox_torrent_file.save(f'{file_name}.torrent', ContentFile(seedbox_torrent_file.to_string()), save=False)
-    batch_obj.save()
+        batch_obj.short_torrent_url = short_urls[0]['short_url']
+        batch_obj.short_magnet_url = short_urls[1]['short_url']
 
-    try:
-        handle_batch_upload(adfly_api, batch_id, batch_path, set_batch_screenshots(batch_id))
-        batch_obj = models.Batch.objects.get(pk=batch_id)
-    except Exception as e:
-        batch_obj.error_message = traceback.format_exc()
-        batch_obj.save()
+        seedbox_torrent_file.announce_urls = torrents.get_announce_urls()
 
-    batch_obj.batch_status = 3
-    batch_obj.published_at = timezone.now()
-    batch_obj.save()
+        batch_obj.seedbox_torrent_file.save(f'{file_name}.torrent', ContentFile(seedbox_torrent_file.to_string()), save=False)
+        batch_obj.save()
 
-    utils.check_and_delete_dir(batch_path)
+        try:
+            handle_batch_upload(adfly_api, batch_id, batch_path, set_batch_screenshots(batch_id))
+            batch_obj = models.Batch.objects.get(pk=batch_id)
+        except Exception as e:
+            batch_obj.error_message = traceback.format_exc()
+            batch_obj.save()
+
+        batch_obj.batch_status = 3
+        batch_obj.published_at = timezone.now()
+        batch_obj.save()
+    finally:
+        utils.check_and_delete_dir(batch_path)
+        admission.release(reservations)
 
 @task
 def handle_batch_bundle(bb_id):
@@ -0,0 +1,560 @@
+import os
+import time
+import mmap
+import bisect
+import hashlib
+import threading
+from pathlib import Path
+from datetime import datetime
+from contextlib import ExitStack
+from urllib.parse import urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from torrentool.api import Torrent
+from torrentool.exceptions import TorrentError
+from torrentool.utils import get_app_version
+
+from core import models, bencode, utils
+
+# Same piece sizes Torrent.create_from picks, so both give the same info hash.
+PIECE_LENGTH_MIN = 32768
+PIECE_LENGTH = 262144
+PAD_DIR = '.pad'
+# v2 hashes files in 16 KiB blocks, the leaves of every file's merkle tree.
+BLOCK_SIZE = 16384
+
+
+def get_announce_urls(upload_site=None):
+    trackers = models.Tracker.objects.all()
+
+    announce_urls = []
+    if upload_site:
+        # The site's own trackers go first so that its peers are tried first.
+        announce_urls.extend(upload_site.trackers.get_trackers())
+        trackers = trackers.exclude(id=upload_site.trackers.id)
+    for track in trackers:
+        announce_urls.extend(track.get_trackers())
+    return announce_urls
+
+
+def load_torrent(torrent_file):
+    # torrentool cannot encode the bytes keys of v2 piece layers.
+    if b'12:meta versioni2e' in torrent_file:
+        return HybridTorrent.from_string(torrent_file)
+    return Torrent.from_string(torrent_file)
+
+
+def load_torrent_file(file_path):
+    with open(file_path, 'rb') as f:
+        return load_torrent(f.read())
+
+
+def derive_torrent(torrent_file, announce_urls):
+    # The info dict, and with it the pieces and the info hash, is kept as is,
+    # only the trackers differ between the seedbox and every upload site.
+    new_torrent = load_torrent(torrent_file)
+    new_torrent.announce_urls = announce_urls
+    return new_torrent
+
+
+def create_torrent(file_path, piece_hasher=None, name=None):
+    hybrid = getattr(settings, 'TORRENT_HYBRID', False)
+    # Stored files can have a storage safe name, the torrent keeps the
+    # episode's own file name.
+    file_name, file_size = name or os.path.basename(file_path), os.path.getsize(file_path)
+
+    if not (piece_hasher and piece_hasher.pieces):
+        if hybrid:
+            piece_hasher = PieceHasher(file_path)
+            piece_hasher.pieces = piece_hasher.finish()
+        if not (piece_hasher and piece_hasher.pieces):
+            new_torrent = Torrent.create_from(file_path)
+            new_torrent.name = file_name
+            return new_torrent
+    info = {
+        'name': file_name,
+        'pieces': piece_hasher.pieces,
+        'piece length': PIECE_LENGTH,
+        'length': file_size,
+    }
+
+    if not (hybrid and piece_hasher.hybrid):
+        new_torrent = Torrent({'info': info})
+        new_torrent.created_by = get_app_version()
+        new_torrent.creation_date = datetime.utcnow()
+        return new_torrent
+
+    pieces_root, piece_layer = get_merkle(piece_hasher.leaves)
+    info.update({
+        'meta version': 2,
+        'file tree': {file_name: {'': {'length': file_size, 'pieces root': pieces_root}}},
+    })
+    return HybridTorrent.create({'info': info, 'piece layers': {pieces_root: piece_layer} if piece_layer else {}})
+
+
+def get_merkle_root(hashes, count, pad_hash):
+    layer = hashes + [pad_hash] * (count - len(hashes))
+    while len(layer) > 1:
+        layer = [hashlib.sha256(layer[i] + layer[i + 1]).digest() for i in range(0, len(layer), 2)]
+    return layer[0]
+
+
+def get_merkle(leaves, piece_length=PIECE_LENGTH):
+    # BEP 52: the leaves past the end of the file are zeros up to the next
+    # power of two. Files longer than a piece also keep the layer with one
+    # hash per piece so that peers can check pieces against the root.
+    blocks_per_piece = piece_length // BLOCK_SIZE
+    zero_leaf = bytes(32)
+
+    if len(leaves) <= blocks_per_piece:
+        return get_merkle_root(leaves, 1 << (len(leaves) - 1).bit_length(), zero_leaf), None
+
+    piece_layer = [
+        get_merkle_root(leaves[i:i + blocks_per_piece], blocks_per_piece, zero_leaf)
+        for i in range(0, len(leaves), blocks_per_piece)
+    ]
+    zero_piece = get_merkle_root([], blocks_per_piece, zero_leaf)
+    pieces_root = get_merkle_root(piece_layer, 1 << (len(piece_layer) - 1).bit_length(), zero_piece)
+    return pieces_root, b''.join(piece_layer)
+
+
+class HybridTorrent:
+
+    def __init__(self, struct):
+        self._struct = struct
+
+    @classmethod
+    def create(cls, struct):
+        new_torrent = cls(struct)
+        new_torrent._struct['created by'] = get_app_version()
+        new_torrent._struct['creation date'] = int(time.time())
+        return new_torrent
+
+    @classmethod
+    def from_string(cls, torrent_file):
+        return cls(bencode.decode(torrent_file))
+
+    def to_string(self):
+        return bencode.encode(self._struct)
+
+    @property
+    def info_hash(self):
+        return hashlib.sha1(bencode.encode(self._struct['info'])).hexdigest()
+
+    @property
+    def info_hash_v2(self):
+        return hashlib.sha256(bencode.encode(self._struct['info'])).hexdigest()
+
+    @property
+    def name(self):
+        return to_text(self._struct['info']['name'])
+
+    @name.setter
+    def name(self, name):
+        self._struct['info']['name'] = name
+
+    @property
+    def total_size(self):
+        return get_content_size(self)
+
+    @property
+    def announce_urls(self):
+        announce_list = self._struct.get('announce-list')
+        if not announce_list:
+            announce = self._struct.get('announce')
+            announce_list = [[announce]] if announce else []
+        return [[to_text(url) for url in tier] for tier in announce_list]
+
+    @announce_urls.setter
+    def announce_urls(self, announce_urls):
+        # Same layout torrentool writes: one url per tier.
+        self._struct.pop('announce-list', None)
+        self._struct['announce'] = announce_urls[0] if announce_urls else ''
+        if len(announce_urls) > 1:
+            self._struct['announce-list'] = [[url] for url in announce_urls]
+
+    def get_magnet(self):
+        params = [('xt', f'urn:btih:{self.info_hash}'), ('xt', f'urn:btmh:1220{self.info_hash_v2}')]
+        announce_urls = self.announce_urls
+        if announce_urls:
+            params.extend(('tr', url) for url in announce_urls[0])
+        return 'magnet:?' + urlencode(params, safe=':')
+
+
+def to_text(value):
+    return value.decode('utf8') if isinstance(value, (bytes, bytearray)) else value
+
+
+MATROSKA_EBML = 0x1A45DFA3
+MATROSKA_SEGMENT = 0x18538067
+MATROSKA_CLUSTER = 0x1F43B675
+
+
+def read_ebml_number(f, keep_marker=False):
+    first = f.read(1)
+    if not first or not first[0]:
+        raise ValueError('Invalid EBML number')
+
+    length = 9 - first[0].bit_length()
+    value = int.from_bytes(first + f.read(length - 1), 'big')
+    # Element ids keep their length marker, sizes drop it.
+    if not keep_marker:
+        value &= (1 << (7 * length)) - 1
+    return value, length
+
+
+def get_matroska_media_offset(f):
+    f.seek(0)
+    if read_ebml_number(f, True)[0] != MATROSKA_EBML:
+        raise ValueError('Not an EBML file')
+    f.seek(read_ebml_number(f)[0], os.SEEK_CUR)
+
+    if read_ebml_number(f, True)[0] != MATROSKA_SEGMENT:
+        raise ValueError('No matroska segment')
+    read_ebml_number(f)
+
+    # The seek head, info, tracks, attachments and tags all come before the
+    # first cluster.
+    while True:
+        offset = f.tell()
+        element_id = read_ebml_number(f, True)[0]
+        if element_id == MATROSKA_CLUSTER:
+            return offset
+
+        size, length = read_ebml_number(f)
+        if size == (1 << (7 * length)) - 1:
+            raise ValueError('Matroska element of unknown size')
+        f.seek(size, os.SEEK_CUR)
+
+
+def get_mp4_media_offset(f, file_size):
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        header = f.read(8)
+        size, box_type, header_size = int.from_bytes(header[:4], 'big'), header[4:], 8
+        if size == 1:
+            size, header_size = int.from_bytes(f.read(8), 'big'), 16
+        elif size == 0:
+            size = file_size - offset
+
+        # The mdat size is filled in once the encode ends.
+        if box_type == b'mdat':
+            return offset + header_size
+        if size < header_size:
+            raise ValueError('Invalid mp4 box')
+        offset += size
+
+    raise ValueError('No mp4 media data')
+
+
+def get_media_offset(f, file_size):
+    """
+    Where the media data of a matroska or mp4 file starts. Muxers can go
+    back and rewrite anything before it, for any other file that is all of it.
+    """
+    try:
+        f.seek(0)
+        if f.read(4) == MATROSKA_EBML.to_bytes(4, 'big'):
+            return get_matroska_media_offset(f)
+        return get_mp4_media_offset(f, file_size)
+    except ValueError:
+        return file_size
+
+
+class PieceHasher:
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.enabled = getattr(settings, 'TORRENT_INLINE_HASH', False)
+        self.interval = getattr(settings, 'TORRENT_INLINE_HASH_INTERVAL', 1)
+        # Muxers go back to the start of the file to fill in sizes, durations
+        # and seek heads once the encode ends, so the pieces there are only
+        # hashed from the finished file. finish re-hashes everything up to
+        # the media data anyway, this only saves hashing them twice.
+        self.header_size = getattr(settings, 'TORRENT_INLINE_HEADER_SIZE', 16 * 1024 ** 2)
+        self.header_pieces = -(-self.header_size // PIECE_LENGTH)
+        self.hybrid = getattr(settings, 'TORRENT_HYBRID', False)
+        self.stop_event = threading.Event()
+        self.inode, self.hashes, self.piece_leaves = None, [], []
+        self.pieces = None
+
+    def __enter__(self):
+        if self.enabled:
+            self.thread = threading.Thread(target=self.follow, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.enabled:
+            return
+
+        self.stop_event.set()
+        self.thread.join()
+
+        if exc_type is None:
+            self.pieces = self.finish()
+
+    def follow(self):
+        while not self.stop_event.wait(self.interval):
+            # Everything past the header is written once, so every piece
+            # that is already complete on disk is final.
+            try:
+                file_stat = os.stat(self.file_path)
+                self.update(file_stat, file_stat.st_size)
+            except FileNotFoundError:
+                continue
+
+    def update(self, file_stat, end, final=False):
+        # Encoders delete and recreate their output, and cache hits link a
+        # new file in its place, either way hashing starts over.
+        if file_stat.st_ino != self.inode or file_stat.st_size < len(self.hashes) * PIECE_LENGTH:
+            self.inode, self.hashes, self.piece_leaves = file_stat.st_ino, [], []
+
+        with open(self.file_path, 'rb') as f:
+            if final:
+                # Attachments and tags can push what the muxer patches past
+                # header_size, so everything before the media data is redone.
+                rewritten_pieces = -(-get_media_offset(f, file_stat.st_size) // PIECE_LENGTH)
+                for index in range(min(rewritten_pieces, len(self.hashes))):
+                    self.hashes[index] = None
+
+            while (len(self.hashes) + 1) * PIECE_LENGTH <= end:
+                if len(self.hashes) < self.header_pieces and not final:
+                    self.hashes.append(None)
+                    self.piece_leaves.append(None)
+                    continue
+                self.hash_piece(f, len(self.hashes))
+
+            if final:
+                for index, piece_hash in enumerate(self.hashes):
+                    if piece_hash is None:
+                        self.hash_piece(f, index)
+
+                if (len(self.hashes) * PIECE_LENGTH) < file_stat.st_size:
+                    self.hash_piece(f, len(self.hashes))
+
+    def hash_piece(self, f, index):
+        f.seek(index * PIECE_LENGTH)
+        data = f.read(PIECE_LENGTH)
+
+        leaves = None
+        if self.hybrid:
+            leaves = [hashlib.sha256(data[i:i + BLOCK_SIZE]).digest() for i in range(0, len(data), BLOCK_SIZE)]
+
+        if index == len(self.hashes):
+            self.hashes.append(None)
+            self.piece_leaves.append(None)
+        self.hashes[index] = hashlib.sha1(data).digest()
+        self.piece_leaves[index] = leaves
+
+    @property
+    def leaves(self):
+        return [leaf for leaves in self.piece_leaves for leaf in leaves]
+
+    def finish(self):
+        file_stat = os.stat(self.file_path)
+        if file_stat.st_size <= PIECE_LENGTH_MIN:
+            return None
+
+        self.update(file_stat, file_stat.st_size, final=True)
+        return b''.join(self.hashes)
+
+
+def get_piece_length(total_size):
+    # Keep the piece count around the usual 1000-2000 for big batches
+    # instead of the fixed 256 KiB Torrent.create_from uses.
+    target_pieces = getattr(settings, 'TORRENT_TARGET_PIECES', 1500)
+    max_piece_length = getattr(settings, 'TORRENT_MAX_PIECE_LENGTH', 16 * 1024 ** 2)
+
+    piece_length = PIECE_LENGTH
+    while total_size / piece_length > target_pieces and piece_length < max_piece_length:
+        piece_length *= 2
+    return piece_length
+
+
+def create_batch_torrent(src_path, piece_length=None):
+    target_files, total_size = Torrent._get_target_files_info(Path(src_path))
+    if not target_files:
+        raise TorrentError('Unable to create torrent for an empty directory.')
+
+    piece_length = piece_length or get_piece_length(total_size)
+    pieces = ParallelPieceHasher(
+        [(file_path, file_size) for file_path, file_size, _ in target_files], piece_length
+    ).hash()
+
+    new_torrent = Torrent({'info': {
+        'name': os.path.basename(os.path.normpath(src_path)),
+        'pieces': pieces,
+        'piece length': piece_length,
+        'files': [{'length': file_size, 'path': path} for _, file_size, path in target_files],
+    }})
+    new_torrent.created_by = get_app_version()
+    new_torrent.creation_date = datetime.utcnow()
+    return new_torrent
+
+
+class ParallelPieceHasher:
+
+    def __init__(self, files, piece_length, workers=None):
+        self.files = files
+        self.piece_length = piece_length
+        self.workers = workers or getattr(settings, 'TORRENT_HASH_WORKERS', os.cpu_count() or 1)
+        self.total_size = sum(file_size for _, file_size in files)
+        self.piece_count = -(-self.total_size // piece_length)
+
+    def hash(self):
+        with ExitStack() as stack:
+            self.maps, self.offsets, offset = [], [], 0
+            for file_path, file_size in self.files:
+                f = stack.enter_context(open(file_path, 'rb'))
+                self.maps.append(stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)))
+                self.offsets.append(offset)
+                offset += file_size
+
+            # sha1 releases the GIL on large buffers, so threads hash in
+            # parallel and, unlike a process pool, also run inside the
+            # daemonic celery workers.
+            ranges = self.get_ranges()
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                return b''.join(executor.map(self.hash_range, *zip(*ranges)))
+
+    def get_ranges(self):
+        # A few ranges per worker even out files that are cached and ones
+        # that have to come from disk.
+        range_count = min(self.piece_count, self.workers * 4)
+        bounds = [self.piece_count * i // range_count for i in range(range_count + 1)]
+        return list(zip(bounds, bounds[1:]))
+
+    def hash_range(self, first_piece, last_piece):
+        hashes = []
+        file_index = bisect.bisect_right(self.offsets, first_piece * self.piece_length) - 1
+
+        for piece in range(first_piece, last_piece):
+            start = piece * self.piece_length
+            end = min(start + self.piece_length, self.total_size)
+            piece_hash = hashlib.sha1()
+
+            # Pieces run on across file boundaries.
+            while start < end:
+                file_offset = start - self.offsets[file_index]
+                file_end = self.offsets[file_index] + len(self.maps[file_index])
+                if file_offset >= len(self.maps[file_index]):
+                    file_index += 1
+                    continue
+                chunk_end = min(end, file_end)
+                with memoryview(self.maps[file_index]) as file_view:
+                    piece_hash.update(file_view[file_offset:chunk_end - self.offsets[file_index]])
+                start = chunk_end
+
+            hashes.append(piece_hash.digest())
+
+        return b''.join(hashes)
+
+
+def get_content_size(torrent):
+    # Padding files only exist to align pieces, they are not content.
+    info = torrent._struct['info']
+    if 'files' not in info:
+        return info['length']
+    return sum(f['length'] for f in info['files'] if 'p' not in to_text(f.get('attr', '')))
+
+
+def get_files(torrent):
+    # (path, size) of every content file, relative to the torrent directory.
+    info = torrent._struct['info']
+    if 'files' not in info:
+        return [(to_text(info['name']), info['length'])]
+    return [
+        ('/'.join(to_text(part) for part in f['path']), f['length'])
+        for f in info['files'] if 'p' not in to_text(f.get('attr', ''))
+    ]
+
+
+def get_episode_hashes(episode_obj, file_size, hybrid):
+    file_path = episode_obj.file.path
+
+    if episode_obj.seedbox_torrent_file:
+        with open(episode_obj.seedbox_torrent_file.path, 'rb') as f:
+            struct = bencode.decode(f.read())
+        info = struct['info']
+
+        if info.get('piece length') == PIECE_LENGTH and info.get('length') == file_size:
+            file_entry = next(iter(info.get('file tree', {}).values()), {}).get('', {})
+            pieces_root = file_entry.get('pieces root')
+            if not hybrid:
+                return info['pieces'], None, None
+            if pieces_root:
+                return info['pieces'], pieces_root, struct.get('piece layers', {}).get(pieces_root)
+
+    if not hybrid:
+        return ParallelPieceHasher([(file_path, file_size)], PIECE_LENGTH).hash(), None, None
+
+    # Episodes from before hybrid torrents have no merkle tree stored yet.
+    piece_hasher = PieceHasher(file_path)
+    pieces = piece_hasher.finish()
+    return (pieces, *get_merkle(piece_hasher.leaves))
+
+
+def create_padded_batch_torrent(src_path, episode_objs):
+    # BEP 47: a padding file after every episode makes the next one start on
+    # a piece boundary, so every full piece of an episode is the same as in
+    # its own seedbox torrent and only the padded tail piece is new.
+    # v2 hybrids are always padded, their file tree lists the same episodes
+    # with the merkle roots stored in the episode seedbox torrents.
+    hybrid = getattr(settings, 'TORRENT_HYBRID', False)
+    episode_objs = sorted(episode_objs, key=lambda e: e.file_name)
+    files, pieces, file_tree, piece_layers = [], [], {}, {}
+
+    for index, episode_obj in enumerate(episode_objs):
+        file_path = episode_obj.file.path
+        file_size = os.path.getsize(file_path)
+        full_pieces = file_size // PIECE_LENGTH
+        tail_size = file_size % PIECE_LENGTH
+        # The last file needs no padding, there is no piece after it.
+        pad_size = PIECE_LENGTH - tail_size if tail_size and index < len(episode_objs) - 1 else 0
+
+        episode_pieces, pieces_root, piece_layer = get_episode_hashes(episode_obj, file_size, hybrid)
+        pieces.append(episode_pieces[:full_pieces * 20])
+
+        files.append({'length': file_size, 'path': [episode_obj.file_name]})
+        if hybrid:
+            file_tree[episode_obj.file_name] = {'': {'length': file_size, 'pieces root': pieces_root}}
+            if piece_layer:
+                piece_layers[pieces_root] = piece_layer
+
+        if tail_size:
+            with open(file_path, 'rb') as f:
+                f.seek(full_pieces * PIECE_LENGTH)
+                pieces.append(hashlib.sha1(f.read() + bytes(pad_size)).digest())
+
+        if pad_size:
+            pad_path = [PAD_DIR, str(pad_size)]
+            files.append({'attr': 'p', 'length': pad_size, 'path': pad_path})
+
+            # Clients that do not know about padding files still find them
+            # complete next to the episodes.
+            pad_file_path = os.path.join(utils.create_and_get_path(os.path.join(src_path, PAD_DIR)), str(pad_size))
+            with open(pad_file_path, 'wb') as f:
+                f.truncate(pad_size)
+
+    if not files:
+        raise TorrentError('Unable to create torrent for an empty batch.')
+
+    info = {
+        'name': os.path.basename(os.path.normpath(src_path)),
+        'pieces': b''.join(pieces),
+        'piece length': PIECE_LENGTH,
+        'files': files,
+    }
+
+    if hybrid:
+        info.update({'meta version': 2, 'file tree': file_tree})
+        return HybridTorrent.create({'info': info, 'piece layers': piece_layers})
+
+    new_torrent = Torrent({'info': info})
+    new_torrent.created_by = get_app_version()
+    new_torrent.creation_date = datetime.utcnow()
+    return new_torrent
@@ -11,4 +11,6 @@ urlpatterns = [
     path('download/torrent/<uuid:episode_uuid>/<file_name>', views.download_torrent, name='download_episode_torrent'),
     path('download/magnet/<uuid:episode_uuid>', views.download_magnet, name='download_episode_magnet'),
     path('download/<uuid:episode_uuid>', views.download, name='download_episode'),
+    path('download/complete/<torrent_hash>', views.download_complete, name='download_complete'),
+    path('metrics', views.metrics, name='metrics'),
 ]
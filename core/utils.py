@@ -66,6 +66,43 @@ def check_and_delete_dir(path):
     if os.path.exists(path):
         shutil.rmtree(path)
 
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    import fcntl
+
+    try:
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    except OSError:
+        check_and_delete(dst)
+        raise
+
+def link_or_copy(src, dst):
+    # A hard link, then a copy-on-write clone (btrfs, xfs) and, across
+    # filesystems, copyfile, which streams through sendfile in the kernel.
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+
+    try:
+        reflink(src, dst)
+        return
+    except (OSError, ImportError):
+        pass
+
+    shutil.copyfile(src, dst)
+
+def move_or_copy(src, dst):
+    try:
+        os.replace(src, dst)
+    except OSError:
+        # Renames only work within a filesystem.
+        link_or_copy(src, dst)
+        os.remove(src)
+
 def wait_state(func1, func2, period=3, timeout=(60 * 60 * 24)):
     must_end = time.time() + timeout
     while time.time() < must_end:
@@ -74,6 +111,12 @@ def wait_state(func1, func2, period=3, timeout=(60 * 60 * 24)):
         time.sleep(period)
     return False
 
+def to_float(value, default=0):
+    try:
+        return float(str(value).rstrip('x'))
+    except (TypeError, ValueError):
+        return default
+
 suffixes = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
 def humansize(nbytes):
     i = 0
@@ -1,10 +1,19 @@
+from django.conf import settings
 from django.shortcuts import render, get_object_or_404, HttpResponseRedirect
-from django.http import FileResponse
+from django.http import FileResponse, HttpResponse, HttpResponseForbidden, Http404
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
 
 from io import BytesIO
-from torrentool.api import Torrent
 
-from core import models, utils
+from core import models, admission, tasks, torrents, utils
+
+def check_token(request, setting_name):
+    # Closed unless a token is configured.
+    token = getattr(settings, setting_name, None)
+    if not token:
+        raise Http404
+    return constant_time_compare(request.GET.get('token', ''), token)
 
 class MagnetRedirect(HttpResponseRedirect):
     allowed_schemes = ['magnet']
@@ -13,7 +22,7 @@ def download_batch_torrent(request, batch_uuid, file_name):
     batch = get_object_or_404(models.Batch, uuid=batch_uuid, file_name=file_name.rstrip('.torrent'))
     seedbox_torrent_file = batch.seedbox_torrent_file
 
-    new_torrent = Torrent.from_file(seedbox_torrent_file.path)
+    new_torrent = torrents.load_torrent_file(seedbox_torrent_file.path)
     announce_urls = utils.flatten_trackers_tiers(new_torrent.announce_urls)
 
     new_announce_urls = []
@@ -28,14 +37,14 @@ def download_batch_magnet(request, batch_uuid):
     batch = get_object_or_404(models.Batch, uuid=batch_uuid)
     seedbox_torrent_file = batch.seedbox_torrent_file
 
-    new_torrent = Torrent.from_file(seedbox_torrent_file.path)
+    new_torrent = torrents.load_torrent_file(seedbox_torrent_file.path)
     return MagnetRedirect(new_torrent.get_magnet())
 
 def download_torrent(request, episode_uuid, file_name):
     episode = get_object_or_404(models.Episode, uuid=episode_uuid, file_name=file_name.rstrip('.torrent'))
     seedbox_torrent_file = episode.seedbox_torrent_file
 
-    new_torrent = Torrent.from_file(seedbox_torrent_file.path)
+    new_torrent = torrents.load_torrent_file(seedbox_torrent_file.path)
     announce_urls = utils.flatten_trackers_tiers(new_torrent.announce_urls)
 
     new_announce_urls = []
@@ -50,9 +59,27 @@ def download_magnet(request, episode_uuid):
     episode = get_object_or_404(models.Episode, uuid=episode_uuid)
     seedbox_torrent_file = episode.seedbox_torrent_file
 
-    new_torrent = Torrent.from_file(seedbox_torrent_file.path)
+    new_torrent = torrents.load_torrent_file(seedbox_torrent_file.path)
     return MagnetRedirect(new_torrent.get_magnet())
 
 def download(request, episode_uuid):
     episode = get_object_or_404(models.Episode, uuid=episode_uuid)
     return FileResponse(episode.file.open('rb'), filename=episode.file_name, as_attachment=True)
+
+@csrf_exempt
+def download_complete(request, torrent_hash):
+    # Meant for qBittorrent's "Run external program on torrent completion",
+    # e.g. curl -s "<SITE_URL>/download/complete/%I?token=<DOWNLOAD_CALLBACK_TOKEN>"
+    if not check_token(request, 'DOWNLOAD_CALLBACK_TOKEN'):
+        return HttpResponseForbidden()
+
+    for pending_obj in models.PendingDownload.objects.filter(torrent_hash=torrent_hash.lower(), status='dl'):
+        tasks.complete_download.delay(pending_obj.id)
+
+    return HttpResponse('Ok.')
+
+def metrics(request):
+    if not check_token(request, 'METRICS_TOKEN'):
+        return HttpResponseForbidden()
+
+    return HttpResponse(admission.get_metrics(), content_type='text/plain; version=0.0.4')